@@ -128,18 +128,22 @@ the concentric boxes will overwhelm the in-memory sort).
 
 __author__ = "bslatkin@gmail.com (Brett Slatkin)"
 
-__all__ = ["compute"]
+__all__ = ["compute", "compute_set", "compute_many"]
 
 import decimal
+import random
+import re
+import sys
+import time
 
 
-def _round_slice_down(coord, slice):
+def _round_slice_down(coord, slice, context):
   try:
-    remainder = coord % slice
+    remainder = context.remainder(coord, slice)
     if coord > 0:
-      return coord - remainder + slice
+      return context.add(context.subtract(coord, remainder), slice)
     else:
-      return coord - remainder
+      return context.subtract(coord, remainder)
   except decimal.InvalidOperation:
     # This happens when the slice is too small for the current coordinate.
     # That means we've already got zeros in the slice's position, so we're
@@ -149,15 +153,15 @@ def _round_slice_down(coord, slice):
 
 def compute_tuple(lat, lon, resolution, slice):
   """Computes the tuple Geobox for a coordinate with a resolution and slice."""
-  decimal.getcontext().prec = resolution + 3
+  context = decimal.Context(prec=resolution + 3)
   lat = decimal.Decimal(str(lat))
   lon = decimal.Decimal(str(lon))
   slice = decimal.Decimal(str(1.0 * slice * 10 ** -resolution))
-  
-  adjusted_lat = _round_slice_down(lat, slice)
-  adjusted_lon = _round_slice_down(lon, slice)
-  return (adjusted_lat, adjusted_lon - slice,
-          adjusted_lat - slice, adjusted_lon)
+
+  adjusted_lat = _round_slice_down(lat, slice, context)
+  adjusted_lon = _round_slice_down(lon, slice, context)
+  return (adjusted_lat, context.subtract(adjusted_lon, slice),
+          context.subtract(adjusted_lat, slice), adjusted_lon)
 
 
 def format_tuple(values, resolution):
@@ -166,29 +170,235 @@ def format_tuple(values, resolution):
   return "|".join(format % v for v in values)
 
 
-def compute(lat, lon, resolution, slice):
-  """Computes the Geobox for a coordinate with a resolution and slice."""
+def compute_decimal(lat, lon, resolution, slice):
+  """Computes the Geobox for a coordinate with decimal arithmetic.
+
+  This is the reference for compute(), and what it falls back to for values
+  it can't parse.
+  """
   return format_tuple(compute_tuple(lat, lon, resolution, slice), resolution)
 
 
-def compute_set(lat, lon, resolution, slice):
-  """Computes the set of adjacent Geoboxes for a coordinate."""
-  decimal.getcontext().prec = resolution + 3
+def compute_set_decimal(lat, lon, resolution, slice):
+  """Computes the set of adjacent Geoboxes with decimal arithmetic.
+
+  This is the reference for compute_set(), and what it falls back to for
+  values it can't parse.
+  """
+  context = decimal.Context(prec=resolution + 3)
   primary_box = compute_tuple(lat, lon, resolution, slice)
   slice = decimal.Decimal(str(1.0 * slice * 10 ** -resolution))
 
   geobox_values = []
   for i in xrange(-1, 2):
-    lat_delta = slice * i
+    lat_delta = context.multiply(slice, i)
     for j in xrange(-1, 2):
-      lon_delta = slice * j
-      adjusted_box = (primary_box[0] + lat_delta, primary_box[1] + lon_delta,
-                      primary_box[2] + lat_delta, primary_box[3] + lon_delta)
+      lon_delta = context.multiply(slice, j)
+      adjusted_box = (context.add(primary_box[0], lat_delta),
+                      context.add(primary_box[1], lon_delta),
+                      context.add(primary_box[2], lat_delta),
+                      context.add(primary_box[3], lon_delta))
       geobox_values.append(format_tuple(adjusted_box, resolution))
 
   return geobox_values
 
 
+# The integer versions below give the same strings as the decimal ones. A
+# number is an integer coefficient and a power of ten exponent, and every
+# decimal operation is done exactly and then rounded to the context's
+# precision, the way the decimal module does it.
+
+_NUMBER = re.compile(r"\s*([-+]?)(\d*)(?:\.(\d*))?(?:[eE]([-+]?\d+))?\s*$")
+
+# Values of fewer digits than this are formatted without going through float.
+_EXACT_FORMAT_LIMIT = 10 ** 15
+
+
+def _parse(value):
+  """Returns the exact value of str(value) as (coefficient, exponent).
+
+  Returns None for anything but a finite number, which the decimal version
+  then handles.
+  """
+  match = _NUMBER.match(str(value))
+  if not match:
+    return None
+  sign, whole, fraction, exponent = match.groups()
+  fraction = fraction or ""
+  if not whole and not fraction:
+    return None
+  coefficient = int(whole + fraction)
+  if sign == "-":
+    coefficient = -coefficient
+  return coefficient, int(exponent or 0) - len(fraction)
+
+
+def _parse_slice(resolution, slice):
+  return _parse(1.0 * slice * 10 ** -resolution)
+
+
+def _round(value, precision):
+  """Rounds to a number of significant digits, half to even."""
+  limit = 10 ** precision
+  if -limit < value < limit:
+    return value
+  magnitude = abs(value)
+  shift = 10 ** (len(str(magnitude)) - precision)
+  quotient, remainder = divmod(magnitude, shift)
+  if 2 * remainder > shift or (2 * remainder == shift and quotient & 1):
+    quotient += 1
+  if value < 0:
+    return -quotient * shift
+  return quotient * shift
+
+
+def _align(coord, slice):
+  """Returns the coordinate and slice as coefficients of a common exponent."""
+  coefficient, exponent = coord
+  slice_coefficient, slice_exponent = slice
+  if exponent < slice_exponent:
+    return (coefficient, slice_coefficient * 10 ** (slice_exponent - exponent),
+            exponent)
+  return (coefficient * 10 ** (exponent - slice_exponent), slice_coefficient,
+          slice_exponent)
+
+
+def _slice_down(coord, slice, precision):
+  """The integer version of _round_slice_down().
+
+  Returns:
+    (adjusted coordinate, slice, exponent of both)
+  """
+  coefficient, slice_coefficient, exponent = _align(coord, slice)
+  if not coefficient:
+    return 0, slice_coefficient, exponent
+  magnitude = abs(coefficient)
+  digits = len(str(magnitude)) - len(str(slice_coefficient))
+  if digits > -2:
+    if digits > precision:
+      return coefficient, slice_coefficient, exponent
+    quotient, remainder = divmod(magnitude, slice_coefficient)
+    if quotient >= 10 ** precision:
+      return coefficient, slice_coefficient, exponent
+  else:
+    remainder = magnitude
+  if coefficient > 0:
+    adjusted = _round(_round(coefficient - _round(remainder, precision),
+                             precision) + slice_coefficient, precision)
+  else:
+    adjusted = _round(coefficient + _round(remainder, precision), precision)
+  return adjusted, slice_coefficient, exponent
+
+
+def _format(coefficient, exponent, resolution):
+  shift = exponent + resolution
+  if shift >= 0:
+    units = coefficient * 10 ** shift
+    if -_EXACT_FORMAT_LIMIT < units < _EXACT_FORMAT_LIMIT:
+      if not resolution:
+        return "%d" % units
+      if units < 0:
+        return "-%d.%0*d" % (-units // 10 ** resolution, resolution,
+                             -units % 10 ** resolution)
+      return "%d.%0*d" % (units // 10 ** resolution, resolution,
+                          units % 10 ** resolution)
+  return "%0.*f" % (resolution, float("%de%d" % (coefficient, exponent)))
+
+
+def _compute_boxes(lat, lon, resolution, slice, use_set):
+  """Computes the Geobox or Geoboxes of parsed values."""
+  precision = resolution + 3
+  lat, lat_slice, lat_exponent = _slice_down(lat, slice, precision)
+  lon, lon_slice, lon_exponent = _slice_down(lon, slice, precision)
+  box = (lat, _round(lon - lon_slice, precision),
+         _round(lat - lat_slice, precision), lon)
+  if not use_set:
+    return ["|".join((_format(box[0], lat_exponent, resolution),
+                      _format(box[1], lon_exponent, resolution),
+                      _format(box[2], lat_exponent, resolution),
+                      _format(box[3], lon_exponent, resolution)))]
+
+  # The adjacent boxes share their edges, so each is only formatted once.
+  columns = []
+  for j in xrange(-1, 2):
+    lon_delta = _round(lon_slice * j, precision)
+    columns.append((
+        _format(_round(box[1] + lon_delta, precision), lon_exponent,
+                resolution),
+        _format(_round(box[3] + lon_delta, precision), lon_exponent,
+                resolution)))
+  geobox_values = []
+  for i in xrange(-1, 2):
+    lat_delta = _round(lat_slice * i, precision)
+    top = _format(_round(box[0] + lat_delta, precision), lat_exponent,
+                  resolution)
+    bottom = _format(_round(box[2] + lat_delta, precision), lat_exponent,
+                     resolution)
+    for left, right in columns:
+      geobox_values.append("|".join((top, left, bottom, right)))
+  return geobox_values
+
+
+def compute(lat, lon, resolution, slice):
+  """Computes the Geobox for a coordinate with a resolution and slice."""
+  parsed_lat = _parse(lat)
+  parsed_lon = _parse(lon)
+  parsed_slice = _parse_slice(resolution, slice)
+  if parsed_lat is None or parsed_lon is None or parsed_slice is None:
+    return compute_decimal(lat, lon, resolution, slice)
+  return _compute_boxes(parsed_lat, parsed_lon, resolution, parsed_slice,
+                        False)[0]
+
+
+def compute_set(lat, lon, resolution, slice):
+  """Computes the set of adjacent Geoboxes for a coordinate."""
+  parsed_lat = _parse(lat)
+  parsed_lon = _parse(lon)
+  parsed_slice = _parse_slice(resolution, slice)
+  if parsed_lat is None or parsed_lon is None or parsed_slice is None:
+    return compute_set_decimal(lat, lon, resolution, slice)
+  return _compute_boxes(parsed_lat, parsed_lon, resolution, parsed_slice,
+                        True)
+
+
+def compute_many(coordinates, configs):
+  """Computes the Geoboxes of many coordinates for many configurations.
+
+  This is the bulk version of compute() and compute_set(), for loading many
+  entities at once: each slice is parsed once for all the coordinates, and
+  each coordinate once for all the configurations.
+
+  Args:
+    coordinates: An iterable of (lat, lon) pairs.
+    configs: A sequence of (resolution, slice, use_set) tuples. With use_set
+      the set of adjacent Geoboxes is computed, as by compute_set(), else
+      the single Geobox, as by compute().
+
+  Returns:
+    A list with, for each coordinate, the list of its Geoboxes for all the
+    configurations in order.
+  """
+  parsed_configs = [(resolution, _parse_slice(resolution, slice), use_set)
+                    for resolution, slice, use_set in configs]
+  all_boxes = []
+  for lat, lon in coordinates:
+    parsed_lat = _parse(lat)
+    parsed_lon = _parse(lon)
+    boxes = []
+    for (resolution, slice, use_set), (unused, parsed_slice, unused) in zip(
+        configs, parsed_configs):
+      if parsed_lat is None or parsed_lon is None or parsed_slice is None:
+        if use_set:
+          boxes.extend(compute_set_decimal(lat, lon, resolution, slice))
+        else:
+          boxes.append(compute_decimal(lat, lon, resolution, slice))
+      else:
+        boxes.extend(_compute_boxes(parsed_lat, parsed_lon, resolution,
+                                    parsed_slice, use_set))
+    all_boxes.append(boxes)
+  return all_boxes
+
+
 def test():
   tests = [
     (("37.78452", "-122.39532", 6, 10), "37.784530|-122.395330|37.784520|-122.395320"),
@@ -219,8 +429,107 @@ def test():
   print "Testing compute_set, expecting %s" % expected
   value = sorted(compute_set("37.78452", "-122.39532", 6, 25))
   assert value == expected, "Failed, found: " + value
+
+  print "Testing compute, compute_set and compute_many against decimal"
+  configs = [(resolution, slice, use_set)
+             for resolution in xrange(0, 7)
+             for slice in (1, 5, 17, 25, 1000)
+             for use_set in (True, False)]
+  coordinates = _random_coordinates(random.Random(0), 100)
+  for (lat, lon), boxes in zip(coordinates,
+                               compute_many(coordinates, configs)):
+    expected = []
+    for resolution, slice, use_set in configs:
+      args = (lat, lon, resolution, slice)
+      if use_set:
+        value = compute_set(*args)
+        assert value == compute_set_decimal(*args), "Failed for %r" % (args,)
+        expected.extend(value)
+      else:
+        value = compute(*args)
+        assert value == compute_decimal(*args), "Failed for %r" % (args,)
+        expected.append(value)
+    assert boxes == expected, "Failed for %r" % ((lat, lon),)
   print "Tests passed"
 
 
+def _random_coordinates(rand, count):
+  """Returns coordinates like the ones stores are added with.
+
+  There are floats, strings of a few digits and values on box edges.
+  """
+  coordinates = []
+  for i in xrange(count):
+    lat = rand.uniform(-90, 90)
+    lon = rand.uniform(-180, 180)
+    if i % 4 == 1:
+      lat = 37.7 + rand.random() * 0.1
+      lon = -122.5 + rand.random() * 0.1
+    elif i % 4 == 2:
+      lat = "%.*f" % (rand.randint(0, 8), lat)
+      lon = "%.*f" % (rand.randint(0, 8), lon)
+    elif i % 4 == 3:
+      lat = round(lat, rand.randint(0, 4))
+      lon = round(lon, rand.randint(0, 4))
+    coordinates.append((lat, lon))
+  return coordinates
+
+
+def benchmark(count=2000):
+  """Times computing the Geoboxes of stores with decimal and integers."""
+  # models.GEOBOX_CONFIGS
+  configs = (
+    (4, 5, True),
+    (3, 2, True),
+    (3, 8, False),
+    (3, 16, False),
+    (2, 5, False),
+  )
+  coordinates = _random_coordinates(random.Random(0), count)
+
+  def with_decimal():
+    all_boxes = []
+    for lat, lon in coordinates:
+      boxes = []
+      for resolution, slice, use_set in configs:
+        if use_set:
+          boxes.extend(compute_set_decimal(lat, lon, resolution, slice))
+        else:
+          boxes.append(compute_decimal(lat, lon, resolution, slice))
+      all_boxes.append(boxes)
+    return all_boxes
+
+  def with_integers():
+    all_boxes = []
+    for lat, lon in coordinates:
+      boxes = []
+      for resolution, slice, use_set in configs:
+        if use_set:
+          boxes.extend(compute_set(lat, lon, resolution, slice))
+        else:
+          boxes.append(compute(lat, lon, resolution, slice))
+      all_boxes.append(boxes)
+    return all_boxes
+
+  def in_bulk():
+    return compute_many(coordinates, configs)
+
+  results = []
+  for name, function in (("decimal", with_decimal),
+                         ("integer", with_integers),
+                         ("compute_many", in_bulk)):
+    start = time.time()
+    results.append(function())
+    elapsed = time.time() - start
+    if name == "decimal":
+      baseline = elapsed
+    print "%-12s %8.1f us per store %6.1fx" % (
+        name, elapsed * 1e6 / count, baseline / elapsed)
+  assert results[0] == results[1] == results[2], "Results differ"
+
+
 if __name__ == "__main__":
-  test()
+  if sys.argv[1:] == ["benchmark"]:
+    benchmark()
+  else:
+    test()
@@ -85,14 +85,8 @@ class Store(db.Model):
     location = db.GeoPt(lat, lon)
     name = kwargs['name']
     new_store = Store(name=name, location=location)
-    all_boxes = []
     new_store.pretty_address = kwargs['address']
-    for (resolution, slice, use_set) in GEOBOX_CONFIGS:
-      if use_set:
-        all_boxes.extend(geobox.compute_set(lat, lon, resolution, slice))
-      else:
-        all_boxes.append(geobox.compute(lat, lon, resolution, slice))
-    new_store.geoboxes = all_boxes
+    new_store.geoboxes = geobox.compute_many([(lat, lon)], GEOBOX_CONFIGS)[0]
     store_hour_dict = _make_hours(kwargs['store_hours'])
     for day, prop in _DAY_DICTIONARY.iteritems():
       setattr(new_store, prop, store_hour_dict[day])
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# vim: set ts=4 sw=4 et tw=79:
+
+"""Throughput and latency benchmark for the counter backend versions.
+
+By default every version is loaded in this process, on top of the SDK's
+service stubs, and driven through its WSGI application. The backend serves
+one request at a time, so requests from the client threads are handed to the
+application one at a time too, and their latency includes the time spent
+waiting for it. With --url, a running dev_appserver (or any deployment of the
+backend) is driven over HTTP instead.
+
+Counter names are drawn from a Zipf distribution, so a few counters get most
+of the traffic, and operations from a configurable mix. Throughput and the
+p50/p99 latency are reported for each version.
+
+Examples:
+
+  benchmark.py --requests 20000 --concurrency 8 /path/to/google_appengine
+  benchmark.py --url http://localhost:8080 --mix inc:0.9,get:0.1 \\
+      /path/to/google_appengine
+"""
+
+import bisect
+import cookielib
+import optparse
+import os
+import random
+import StringIO
+import sys
+import threading
+import time
+import urllib
+import urllib2
+
+USAGE = """%prog [options] SDK_PATH
+
+SDK_PATH    Path to the SDK installation"""
+
+VERSIONS = ('counter_v1_with_shutdown', 'counter_v2_with_memory_limit',
+            'counter_v3_with_write_behind')
+
+
+class ZipfNames(object):
+    """Picks counter names with probability proportional to 1 / rank ** s."""
+
+    def __init__(self, count, s):
+        self._names = ['counter-%d' % i for i in xrange(count)]
+        self._cdf = []
+        total = 0.0
+        for rank in xrange(1, count + 1):
+            total += 1.0 / rank ** s
+            self._cdf.append(total)
+        self._total = total
+
+    def pick(self, rand):
+        index = bisect.bisect_left(self._cdf, rand.random() * self._total)
+        return self._names[min(index, len(self._names) - 1)]
+
+
+class OpMix(object):
+    """Picks operations according to weights such as 'inc:0.8,get:0.2'."""
+
+    def __init__(self, spec):
+        self._ops = []
+        self._cdf = []
+        total = 0.0
+        for item in spec.split(','):
+            op, weight = item.split(':')
+            if op not in ('get', 'inc', 'dec'):
+                raise ValueError('Unknown operation %r.' % op)
+            total += float(weight)
+            self._ops.append(op)
+            self._cdf.append(total)
+        self._total = total
+
+    def pick(self, rand):
+        return self._ops[bisect.bisect_left(self._cdf,
+                                            rand.random() * self._total)]
+
+
+class WsgiTarget(object):
+    """Sends requests to a version's WSGI application in this process."""
+
+    def __init__(self, version):
+        # Loaded fresh, so every version starts with an empty CounterStore.
+        sys.modules.pop(version, None)
+        self.name = version
+        self._application = __import__(version).application
+        self._lock = threading.Lock()
+
+    def post(self, path, payload):
+        environ = {
+            'REQUEST_METHOD': 'POST',
+            'PATH_INFO': path,
+            'SCRIPT_NAME': '',
+            'QUERY_STRING': '',
+            'SERVER_NAME': 'localhost',
+            'SERVER_PORT': '8080',
+            'SERVER_PROTOCOL': 'HTTP/1.1',
+            'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+            'CONTENT_LENGTH': str(len(payload)),
+            'wsgi.input': StringIO.StringIO(payload),
+            'wsgi.errors': sys.stderr,
+            'wsgi.url_scheme': 'http',
+            'wsgi.version': (1, 0),
+            'wsgi.multithread': False,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        status = []
+        def start_response(status_line, headers, exc_info=None):
+            status.append(status_line)
+        self._lock.acquire()
+        try:
+            body = ''.join(self._application(environ, start_response))
+        finally:
+            self._lock.release()
+        return status[0].startswith('200'), body
+
+
+class HttpTarget(object):
+    """Sends requests to a running server over HTTP."""
+
+    def __init__(self, url):
+        self.name = url
+        self._url = url.rstrip('/')
+        # The counter urls are login: admin, so log in to the dev_appserver.
+        jar = cookielib.CookieJar()
+        self._opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(jar))
+        self._opener.open('%s/_ah/login?%s' % (self._url, urllib.urlencode(
+            {'email': 'test@example.com', 'admin': 'True',
+             'action': 'Login'}))).read()
+
+    def post(self, path, payload):
+        try:
+            response = self._opener.open(self._url + path, payload)
+            return True, response.read()
+        except urllib2.URLError, e:
+            return False, str(e)
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def run(target, options, names, mix):
+    """Drive 'target' from options.concurrency threads and report on it."""
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    per_thread = options.requests // options.concurrency
+
+    def worker(seed):
+        rand = random.Random(seed)
+        mine = []
+        failed = 0
+        for _ in xrange(per_thread):
+            payload = urllib.urlencode({'name': names.pick(rand),
+                                        'delta': '1'})
+            path = '/backend/counter/%s' % mix.pick(rand)
+            start = time.time()
+            ok, _ = target.post(path, payload)
+            mine.append(time.time() - start)
+            if not ok:
+                failed += 1
+        lock.acquire()
+        try:
+            latencies.extend(mine)
+            errors[0] += failed
+        finally:
+            lock.release()
+
+    threads = [threading.Thread(target=worker, args=(options.seed + i,))
+               for i in xrange(options.concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    latencies.sort()
+    print '%-32s %8d %8d %10.1f %9.2f %9.2f' % (
+        target.name, len(latencies), errors[0],
+        len(latencies) / max(elapsed, 1e-6),
+        percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000)
+
+
+def setup_stubs():
+    """Activate a testbed with the stubs the counter versions use."""
+    from google.appengine.api import apiproxy_stub_map
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.setup_env(BACKEND_ID='counter', INSTANCE_ID='0', overwrite=True)
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub()
+    try:
+        # runtime.memory_usage(), used by the memory limited versions.
+        from google.appengine.api.system import system_stub
+        apiproxy_stub_map.apiproxy.RegisterStub(
+            'system', system_stub.SystemServiceStub())
+    except ImportError:
+        pass
+    return bed
+
+
+def main():
+    parser = optparse.OptionParser(USAGE)
+    parser.add_option('--url', dest='url',
+                      help='Benchmark the server at this url instead of the '
+                      'versions in this process.')
+    parser.add_option('--versions', dest='versions',
+                      default=','.join(VERSIONS),
+                      help='Comma separated modules to benchmark in process '
+                      '(default: %default).')
+    parser.add_option('--requests', dest='requests', type='int', default=10000,
+                      help='Requests per version (default: %default).')
+    parser.add_option('--concurrency', dest='concurrency', type='int',
+                      default=4, help='Client threads (default: %default).')
+    parser.add_option('--counters', dest='counters', type='int', default=1000,
+                      help='Distinct counter names (default: %default).')
+    parser.add_option('--zipf', dest='zipf', type='float', default=1.1,
+                      help='Zipf exponent of the counter name skew; 0 is '
+                      'uniform (default: %default).')
+    parser.add_option('--mix', dest='mix', default='inc:0.8,get:0.15,dec:0.05',
+                      help='Operation weights (default: %default).')
+    parser.add_option('--seed', dest='seed', type='int', default=0,
+                      help='Random seed (default: %default).')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        print 'Error: Exactly 1 argument required.'
+        parser.print_help()
+        sys.exit(1)
+    if options.concurrency < 1:
+        parser.error('--concurrency must be at least 1')
+
+    sys.path.insert(0, args[0])
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    names = ZipfNames(options.counters, options.zipf)
+    mix = OpMix(options.mix)
+    print '%-32s %8s %8s %10s %9s %9s' % (
+        'version', 'requests', 'errors', 'req/s', 'p50 ms', 'p99 ms')
+    if options.url:
+        run(HttpTarget(options.url), options, names, mix)
+        return
+    for version in options.versions.split(','):
+        bed = setup_stubs()
+        try:
+            run(WsgiTarget(version), options, names, mix)
+        finally:
+            bed.deactivate()
+
+
+if __name__ == '__main__':
+    main()
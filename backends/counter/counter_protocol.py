@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+#
+# Copyright 2011 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# vim: set ts=4 sw=4 et tw=79:
+
+"""Wire formats for batches of counter operations.
+
+A batch is a list of (op, name, delta) tuples, where op is one of 'get', 'inc'
+or 'dec', and is answered with the list of counter values after each
+operation. The codec is chosen by the Content-Type of the request, so new
+formats can be added with register_codec().
+"""
+
+import struct
+
+
+OPS = ('get', 'inc', 'dec')
+
+
+class ProtocolError(Exception):
+    """A batch could not be encoded or decoded."""
+
+
+class BinaryCodec(object):
+    """A compact binary format.
+
+    Each operation is a one byte op code, a two byte name length, the UTF-8
+    name, so at most MAX_NAME_BYTES long, and an eight byte signed delta.
+    The response is the eight byte signed value of each counter. All
+    integers are big-endian.
+    """
+
+    content_type = 'application/x-counter-batch'
+
+    MAX_NAME_BYTES = 0xffff
+
+    _OP_HEADER = struct.Struct('>BH')
+    _DELTA = struct.Struct('>q')
+
+    def encode_request(self, operations):
+        parts = []
+        for op, name, delta in operations:
+            name = name.encode('utf-8')
+            if len(name) > self.MAX_NAME_BYTES:
+                raise ProtocolError('Counter name of %d bytes is longer than '
+                                    '%d.' % (len(name), self.MAX_NAME_BYTES))
+            parts.append(self._OP_HEADER.pack(OPS.index(op), len(name)))
+            parts.append(name)
+            try:
+                parts.append(self._DELTA.pack(delta))
+            except struct.error:
+                raise ProtocolError('Delta %d is out of range.' % delta)
+        return ''.join(parts)
+
+    def decode_request(self, body):
+        operations = []
+        offset = 0
+        try:
+            while offset < len(body):
+                op_code, name_length = self._OP_HEADER.unpack_from(body,
+                                                                   offset)
+                offset += self._OP_HEADER.size
+                name = body[offset:offset + name_length].decode('utf-8')
+                offset += name_length
+                (delta,) = self._DELTA.unpack_from(body, offset)
+                offset += self._DELTA.size
+                operations.append((OPS[op_code], name, delta))
+        except (struct.error, IndexError, UnicodeDecodeError), e:
+            raise ProtocolError('Malformed batch at byte %d: %s' % (offset, e))
+        return operations
+
+    def encode_response(self, values):
+        try:
+            return struct.pack('>%dq' % len(values), *values)
+        except struct.error:
+            raise ProtocolError('A counter value is out of range.')
+
+    def decode_response(self, body):
+        if len(body) % self._DELTA.size:
+            raise ProtocolError('Malformed response of %d bytes.' % len(body))
+        return list(struct.unpack('>%dq' % (len(body) / self._DELTA.size),
+                                  body))
+
+
+class TextCodec(object):
+    """A readable format for debugging: one 'op name delta' line each.
+
+    Names may not be empty or contain whitespace. The response is one value
+    per line.
+    """
+
+    content_type = 'text/plain'
+
+    def encode_request(self, operations):
+        lines = []
+        for op, name, delta in operations:
+            name = name.encode('utf-8')
+            if name.split() != [name]:
+                raise ProtocolError('Counter name %r is empty or contains '
+                                    'whitespace.' % name)
+            lines.append('%s %s %d\n' % (op, name, delta))
+        return ''.join(lines)
+
+    def decode_request(self, body):
+        operations = []
+        for line in body.splitlines():
+            try:
+                op, name, delta = line.split()
+                delta = int(delta)
+                name = name.decode('utf-8')
+            except (ValueError, UnicodeDecodeError):
+                raise ProtocolError('Malformed line %r.' % line)
+            if op not in OPS:
+                raise ProtocolError('Unknown operation %r.' % op)
+            operations.append((op, name, delta))
+        return operations
+
+    def encode_response(self, values):
+        return ''.join('%d\n' % value for value in values)
+
+    def decode_response(self, body):
+        try:
+            return [int(line) for line in body.splitlines()]
+        except ValueError:
+            raise ProtocolError('Malformed response %r.' % body)
+
+
+_codecs = {}
+
+
+def register_codec(codec):
+    """Make 'codec' available for requests with its content_type."""
+    _codecs[codec.content_type] = codec
+
+
+def get_codec(content_type):
+    """Returns the codec for 'content_type', ignoring any parameters.
+
+    Raises:
+      ProtocolError: There is no codec for 'content_type'.
+    """
+    codec = _codecs.get(content_type.split(';')[0].strip())
+    if codec is None:
+        raise ProtocolError('Unsupported Content-Type %r.' % content_type)
+    return codec
+
+
+register_codec(BinaryCodec())
+register_codec(TextCodec())
+
+DEFAULT_CODEC = BinaryCodec.content_type
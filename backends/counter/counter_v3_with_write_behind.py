@@ -20,7 +20,6 @@
 __author__ = 'Greg Darke <darke@google.com>'
 
 import logging
-import math
 import time
 
 from google.appengine.api import backends
@@ -30,9 +29,13 @@ from google.appengine.ext import db
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp.util import run_wsgi_app
 
+import counter_protocol
+
 
 _MEMORY_LIMIT = 128  # The memory limit for a B1 server
 _CULL_AMOUNT = 0.15
+_MAX_ENTRIES = 200000  # The most counters kept in memory
+_MEMORY_CHECK_INTERVAL = 1000  # Lookups between samples of memory usage
 
 
 def _get_taskqueue_target():
@@ -42,7 +45,8 @@ def _get_taskqueue_target():
 class CounterModel(db.Model):
     value = db.IntegerProperty(default=0)
     _dirty = False
-    _last_accessed = None
+    _lru_prev = None
+    _lru_next = None
 
     @classmethod
     def get_or_new(cls, name):
@@ -52,37 +56,123 @@ class CounterModel(db.Model):
         return model
 
 
-class CounterStore(object):
+class _LruHead(object):
+    """The sentinel that a _LruList starts and ends at."""
+    _lru_prev = None
+    _lru_next = None
+
+
+class _LruList(object):
+    """A doubly linked list of CounterModels, least recently used first.
+
+    The links are kept on the models themselves, so that moving a model to
+    the end of the list or removing it are O(1).
+    """
+
     def __init__(self):
+        self._head = _LruHead()
+        self._head._lru_prev = self._head._lru_next = self._head
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        model = self._head._lru_next
+        while model is not self._head:
+            next_model = model._lru_next
+            yield model
+            model = next_model
+
+    def append(self, model):
+        """Add 'model' as the most recently used entry."""
+        last = self._head._lru_prev
+        model._lru_prev = last
+        model._lru_next = self._head
+        last._lru_next = model
+        self._head._lru_prev = model
+        self._length += 1
+
+    def remove(self, model):
+        model._lru_prev._lru_next = model._lru_next
+        model._lru_next._lru_prev = model._lru_prev
+        model._lru_prev = model._lru_next = None
+        self._length -= 1
+
+    def touch(self, model):
+        """Mark 'model' as the most recently used entry."""
+        self.remove(model)
+        self.append(model)
+
+    def first(self):
+        """Returns the least recently used entry, or None if empty."""
+        if not self._length:
+            return None
+        return self._head._lru_next
+
+
+class CounterStore(object):
+    def __init__(self, max_entries=_MAX_ENTRIES):
         self._store = {}
+        # Every counter in _store is in exactly one of these, depending on
+        # whether it has changes not yet written to datastore.
+        self._clean = _LruList()
+        self._unwritten = _LruList()
         self._has_shutdown = False
         self._dirty = False
         self._batch_size = 100
+        self._max_entries = max_entries
+        self._entry_budget = max_entries
+        self._lookups = 0
+        # Flush tasks are numbered, and named after this instance's start
+        # time and their number, so that each is only enqueued and run once.
+        # The numbers restart with every instance lifetime, so tasks carry
+        # the start time too, and only tasks from this lifetime are deduped.
+        self._started = int(time.time() * 1000)
+        self._flush_sequence = 0
+        self._flushed_sequence = 0
+        self._stats = {'flushes': 0, 'flushed_counters': 0,
+                       'last_flush_ms': 0, 'max_flush_ms': 0,
+                       'total_flush_ms': 0}
+
+    def _lru_for(self, model):
+        if model._dirty:
+            return self._unwritten
+        return self._clean
 
     def get_value(self, name):
         self._ensure_within_memory_limit()
 
-        if name not in self._store:
+        model = self._store.get(name)
+        if model is None:
             model = CounterModel.get_or_new(name)
             self._store[name] = model
+            self._lru_for(model).append(model)
         else:
-            model = self._store[name]
-
-        model._last_accessed = time.time()
+            self._lru_for(model).touch(model)
         return model
 
     def inc_value(self, name, delta):
         if not self._dirty:
             # Enqueue a task with a 'target' specifying traffic be sent to this
             # instance of the backend.
+            self._flush_sequence += 1
             taskqueue.add(url='/backend/counter/flush',
+                          name='flush-%d-%d-%d' % (backends.get_instance(),
+                                                   self._started,
+                                                   self._flush_sequence),
+                          params={'sequence': self._flush_sequence,
+                                  'started': self._started},
                           target=_get_taskqueue_target(),
                           countdown=2)
             self._dirty = True
 
         model = self.get_value(name)
         model.value += delta
-        model._dirty = True
+        if not model._dirty:
+            self._clean.remove(model)
+            model._dirty = True
+            self._unwritten.append(model)
         if self._has_shutdown:
             # Since the shutdown hook may be called at any time, we need to
             # protect ourselves against this.
@@ -90,56 +180,142 @@ class CounterStore(object):
         return model
 
     def _ensure_within_memory_limit(self):
-        memory_limit = _MEMORY_LIMIT * 0.8
-
-        memory_usage = runtime.memory_usage().current()
-        if memory_usage >= memory_limit:
-            # Create a list of candidate counters to remove. We remove counters
-            # that have not been modified before those that have been modified,
-            # then order them by the last time they were accessed.
-            counters = self._store.values()
-            counters.sort(key=lambda counter: (counter._dirty,
-                                               counter._last_accessed))
-            counters_to_cull = int(math.ceil(len(counters) * _CULL_AMOUNT))
-            counters = counters[:counters_to_cull]
-
-            logging.info('Removing %d entries as we are over the memory limit '
-                         'by %dMB.',
-                         counters_to_cull, memory_limit - memory_usage)
+        """Evict the least recently used counters if over the entry budget.
 
-            self._write_in_batches(counters)
-            for counter in counters:
-                del self._store[counter.key().name()]
+        Memory usage is only sampled every _MEMORY_CHECK_INTERVAL lookups. When
+        it is over the limit the entry budget shrinks by _CULL_AMOUNT, and it
+        grows back while usage stays low. At most one batch of counters is
+        evicted per call, clean ones first, so that a large cull is spread
+        over many requests instead of stalling one.
+        """
+        self._lookups += 1
+        if self._lookups % _MEMORY_CHECK_INTERVAL == 0:
+            memory_limit = _MEMORY_LIMIT * 0.8
+            memory_usage = runtime.memory_usage().current()
+            if memory_usage >= memory_limit:
+                self._entry_budget = int(len(self._store) * (1 - _CULL_AMOUNT))
+                logging.info('Reducing the counter budget to %d entries as we '
+                             'are over the memory limit by %dMB.',
+                             self._entry_budget, memory_usage - memory_limit)
+            elif self._entry_budget < self._max_entries:
+                self._entry_budget = min(
+                    self._max_entries,
+                    int(self._entry_budget * (1 + _CULL_AMOUNT)) + 1)
+
+        excess = len(self._store) - self._entry_budget
+        if excess > 0:
+            self._evict(min(excess, self._batch_size))
+
+    def _evict(self, count):
+        """Remove 'count' counters, writing out any unwritten ones first."""
+        while count and self._clean:
+            model = self._clean.first()
+            self._clean.remove(model)
+            del self._store[model.key().name()]
+            count -= 1
+
+        if count:
+            counters = []
+            for model in self._unwritten:
+                if len(counters) >= count:
+                    break
+                counters.append(model)
+            self._put_counters(counters)
+            for model in counters:
+                self._clean.remove(model)
+                del self._store[model.key().name()]
 
     def _put_counters(self, counters):
         db.put(counters)
         for counter in counters:
-            counter._dirty = False
+            if counter._dirty:
+                self._unwritten.remove(counter)
+                counter._dirty = False
+                self._clean.append(counter)
 
     def _write_in_batches(self, counters):
-        """Write out the dirty entries from 'counters' in batches.
+        """Write out 'counters' in parallel batches.
 
-        The batch size is determined by self._batch_size.
+        The batch size is determined by self._batch_size. Every batch is put
+        with db.put_async before waiting on any of them. Counters in batches
+        that fail stay unwritten, and the first error is raised once all the
+        batches have finished.
 
         Args:
-          counters: An iterable containing instances of CounterModel.
+          counters: A list of instances of CounterModel to write.
         """
-        to_put = []
-        for counter in counters:
-            if counter._dirty:
-                to_put.append(counter)
-
-                if len(to_put) >= self._batch_size:
-                    self._put_counters(to_put)
-                    to_put = []
+        rpcs = []
+        for start in xrange(0, len(counters), self._batch_size):
+            batch = counters[start:start + self._batch_size]
+            rpcs.append((batch, db.put_async(batch)))
 
-        if to_put:
-            self._put_counters(to_put)
+        error = None
+        for batch, rpc in rpcs:
+            try:
+                rpc.get_result()
+            except Exception, e:
+                logging.exception('Failed to write %d counters.', len(batch))
+                error = error or e
+                continue
+            for counter in batch:
+                if counter._dirty:
+                    self._unwritten.remove(counter)
+                    counter._dirty = False
+                    self._clean.append(counter)
+        if error:
+            raise error
+
+    def flush_to_datastore(self, sequence=None, started=None):
+        """Write the unwritten counters to datastore.
+
+        Only the counters with unwritten changes are visited, so this is
+        O(unwritten counters) however many counters are held.
 
-    def flush_to_datastore(self):
-        """Write the dirty entries from _store to datastore."""
-        self._write_in_batches(self._store.itervalues())
+        Args:
+          sequence: The sequence number of the flush task, if any. A flush
+              whose number has already completed is skipped, so a retried
+              task does nothing.
+          started: The start time of the instance lifetime that enqueued the
+              flush task. Tasks from other lifetimes just flush, without
+              touching this lifetime's sequence numbers.
+        """
+        if started != self._started:
+            sequence = None
+        if sequence is not None and sequence <= self._flushed_sequence:
+            # While there are changes, the newest task must still be queued
+            # to write them; if it has already run, flush here instead.
+            if (not self._dirty or
+                    self._flush_sequence > self._flushed_sequence):
+                logging.info('Skipping flush %d, which already completed.',
+                             sequence)
+                return
+        start = time.time()
+        counters = list(self._unwritten)
+        # Changes made from here on enqueue a new flush task.
         self._dirty = False
+        try:
+            self._write_in_batches(counters)
+        except:
+            self._dirty = True
+            raise
+        if sequence is not None:
+            self._flushed_sequence = max(self._flushed_sequence, sequence)
+
+        elapsed_ms = int((time.time() - start) * 1000)
+        self._stats['flushes'] += 1
+        self._stats['flushed_counters'] += len(counters)
+        self._stats['last_flush_ms'] = elapsed_ms
+        self._stats['max_flush_ms'] = max(self._stats['max_flush_ms'],
+                                          elapsed_ms)
+        self._stats['total_flush_ms'] += elapsed_ms
+
+    def get_stats(self):
+        """Returns a dict of flush metrics and the current backlog."""
+        stats = dict(self._stats)
+        stats['unwritten_counters'] = len(self._unwritten)
+        stats['counters'] = len(self._store)
+        stats['flushed_sequence'] = self._flushed_sequence
+        return stats
 
     def shutdown_hook(self):
         """Ensures all counters are written to datastore."""
@@ -163,7 +339,26 @@ class FlushHandler(webapp.RequestHandler):
     This handler is protected by login: admin in app.yaml.
     """
     def post(self):
-        _counter_store.flush_to_datastore()
+        sequence = self.request.get('sequence')
+        started = self.request.get('started')
+        if sequence and started:
+            _counter_store.flush_to_datastore(int(sequence), int(started))
+        else:
+            _counter_store.flush_to_datastore()
+
+
+class StatsHandler(webapp.RequestHandler):
+    """Handler for counter/stats.
+
+    Reports flush latency and the backlog of unwritten counters, one
+    'name value' pair per line. This handler is protected by login: admin in
+    app.yaml.
+    """
+    def get(self):
+        self.response.headers['Content-Type'] = 'text/plain'
+        for name, value in sorted(_counter_store.get_stats().iteritems()):
+            self.response.out.write('%s %d\n' % (name, value))
+
 
 class CounterHandler(webapp.RequestHandler):
     """Handler for counter/{get,inc,dec}.
@@ -212,8 +407,56 @@ class CounterHandler(webapp.RequestHandler):
         self.response.out.write('%d' % model.value)
 
 
+class BatchHandler(webapp.RequestHandler):
+    """Handler for counter/batch.
+
+    Applies a batch of (op, name, delta) operations, encoded as described in
+    counter_protocol, and returns the value of the counter after each one in
+    the same encoding. This handler is protected by login: admin in app.yaml.
+    """
+
+    def _write_error(self, error_message):
+        self.response.error(400)
+        self.response.out.write(error_message)
+
+    def post(self):
+        try:
+            codec = counter_protocol.get_codec(
+                self.request.headers.get('Content-Type', ''))
+            operations = codec.decode_request(self.request.body)
+        except counter_protocol.ProtocolError, e:
+            self._write_error(str(e))
+            return
+
+        for op, name, delta in operations:
+            if not name:
+                self._write_error('Operation did not have a name.')
+                return
+
+        values = []
+        for op, name, delta in operations:
+            if op == 'get':
+                model = _counter_store.get_value(name)
+            elif op == 'inc':
+                model = _counter_store.inc_value(name, delta)
+            else:
+                model = _counter_store.inc_value(name, -delta)
+            values.append(model.value)
+
+        try:
+            body = codec.encode_response(values)
+        except counter_protocol.ProtocolError, e:
+            self.error(500)
+            self.response.out.write(str(e))
+            return
+        self.response.headers['Content-Type'] = codec.content_type
+        self.response.out.write(body)
+
+
 _handlers = [(r'/_ah/start', StartHandler),
              (r'/backend/counter/flush$', FlushHandler),
+             (r'/backend/counter/stats$', StatsHandler),
+             (r'/backend/counter/batch$', BatchHandler),
              (r'/backend/counter/(get|inc|dec)$', CounterHandler)]
 
 application = webapp.WSGIApplication(_handlers)
@@ -19,7 +19,6 @@
 __author__ = 'Greg Darke <darke@google.com>'
 
 import os
-import urllib
 
 from google.appengine.api import backends
 from google.appengine.api import urlfetch
@@ -27,35 +26,144 @@ from google.appengine.ext import webapp
 from google.appengine.ext.webapp import template
 from google.appengine.ext.webapp.util import run_wsgi_app
 
+import counter_protocol
+
 
 TEMPLATE_ROOT = os.path.dirname(__file__)
+_MAX_BATCH_SIZE = 500  # The most operations sent in one request
+
+
+class CounterError(Exception):
+    """A batch of counter operations failed."""
+
+
+class _Batch(object):
+    """Up to _MAX_BATCH_SIZE operations sent in one request."""
+
+    def __init__(self, codec):
+        self.codec = codec
+        self.operations = []
+        self._rpc = None
+        self._values = None
+
+    def send(self):
+        """Start the request with an asynchronous urlfetch.
+
+        Raises:
+          CounterError: The operations could not be encoded.
+        """
+        if self._rpc is None:
+            try:
+                payload = self.codec.encode_request(self.operations)
+            except counter_protocol.ProtocolError, e:
+                raise CounterError(str(e))
+            self._rpc = urlfetch.create_rpc()
+            urlfetch.make_fetch_call(
+                self._rpc,
+                '%s/backend/counter/batch' % backends.get_url('counter'),
+                method='POST',
+                payload=payload,
+                headers={'Content-Type': self.codec.content_type})
+
+    def get_values(self):
+        """Wait for the request and return the counter values.
+
+        Raises:
+          CounterError: The request failed.
+        """
+        if self._values is None:
+            self.send()
+            try:
+                result = self._rpc.get_result()
+            except urlfetch.Error, e:
+                raise CounterError('Request to counter backend failed: %s' % e)
+            if result.status_code != 200:
+                raise CounterError('Counter backend returned %d: %s' %
+                                   (result.status_code, result.content))
+            try:
+                values = self.codec.decode_response(result.content)
+            except counter_protocol.ProtocolError, e:
+                raise CounterError(str(e))
+            if len(values) != len(self.operations):
+                raise CounterError(
+                    'Counter backend returned %d values for %d operations.' %
+                    (len(values), len(self.operations)))
+            self._values = values
+        return self._values
+
+
+class CounterResult(object):
+    """The value of a counter after an operation queued on a CounterClient."""
+
+    def __init__(self, client, batch, index):
+        self._client = client
+        self._batch = batch
+        self._index = index
+
+    def get_result(self):
+        """Returns the counter value, sending queued operations if needed.
+
+        Raises:
+          CounterError: The batch with this operation failed.
+        """
+        self._client.send()
+        return self._batch.get_values()[self._index]
+
+
+class CounterClient(object):
+    """Coalesces counter operations into batch requests to the backend.
+
+    Operations are only queued until a result is first needed or send() is
+    called. Then everything queued is sent at once, _MAX_BATCH_SIZE
+    operations per request, with the requests made in parallel. Use one
+    client per request.
+    """
 
+    def __init__(self, content_type=counter_protocol.DEFAULT_CODEC):
+        self._codec = counter_protocol.get_codec(content_type)
+        self._unsent = []
 
-def _call_counter_method(method, name, delta='0'):
-    """Call 'method' on the counter backend.
+    def _queue(self, op, name, delta):
+        if (not self._unsent or
+            len(self._unsent[-1].operations) >= _MAX_BATCH_SIZE):
+            self._unsent.append(_Batch(self._codec))
+        batch = self._unsent[-1]
+        batch.operations.append((op, name, int(delta)))
+        return CounterResult(self, batch, len(batch.operations) - 1)
 
-    Args:
-      method: The method. One of 'inc', 'dec', 'get'.
-      name: The counter to apply 'method' to.
-      delta: The amount to increase/decrease the counter.
+    def get(self, name):
+        return self._queue('get', name, 0)
 
-    Returns: An instance of urlfetch._URLFetchResult
-    """
-    payload = urllib.urlencode({'name': name, 'delta': delta})
-    url = '%s/backend/counter/%s' % (backends.get_url('counter'), method)
-    return urlfetch.fetch(url, method='POST', payload=payload)
+    def inc(self, name, delta=1):
+        return self._queue('inc', name, delta)
+
+    def dec(self, name, delta=1):
+        return self._queue('dec', name, delta)
+
+    def send(self):
+        """Send all queued operations without waiting for the results."""
+        for batch in self._unsent:
+            batch.send()
+        self._unsent = []
 
 
 class MainHandler(webapp.RequestHandler):
     def get(self):
-        result = _call_counter_method('inc', name='visitor', delta='1')
+        counters = CounterClient()
+        visitor = counters.inc('visitor')
+        try:
+            backend_result = visitor.get_result()
+            was_success = True
+        except CounterError, e:
+            backend_result = str(e)
+            was_success = False
 
         self.response.headers['Content-Type'] = 'text/html'
         self.response.out.write(
             template.render(os.path.join(TEMPLATE_ROOT, 'welcome.html'),
-                            {'backend_result': result.content.strip(),
+                            {'backend_result': backend_result,
                              'source_code': '/static/counter_demo.zip',
-                             'was_success': result.status_code == 200}))
+                             'was_success': was_success}))
 
 
 _handlers = [(r'/', MainHandler)]
@@ -26,14 +26,21 @@ __author__ = 'Bret Taylor'
 
 import cgi
 import datetime
+import difflib
+import logging
 import os
+import pickle
 import re
 import sys
+import threading
 import urllib
 import urlparse
+import zlib
 
 from google.appengine.api import datastore
+from google.appengine.api import datastore_errors
 from google.appengine.api import datastore_types
+from google.appengine.api import memcache
 from google.appengine.api import users
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp import template
@@ -42,6 +49,28 @@ from google.appengine.ext.webapp.util import run_wsgi_app
 # Set to true if we want to have our webapp print stack traces, etc
 _DEBUG = True
 
+# Set to false once /_migrate reports that all pages have been migrated, so
+# pages that aren't stored under their key names are no longer looked for
+_LEGACY_PAGES = True
+
+# Prefix of the key names of pages, which are derived from the page names
+_KEY_NAME_PREFIX = 'page:'
+
+# The number of pages /_migrate migrates in each request
+_MIGRATE_BATCH_SIZE = 50
+
+# The number of revisions listed in the history of a page
+_HISTORY_SIZE = 50
+
+# Prefix of the memcache keys that record whether a page exists
+_EXISTS_PREFIX = 'exists:'
+
+# Prefix of the memcache keys of wikified page contents
+_HTML_PREFIX = 'html:'
+
+# The number of wikified pages each instance keeps in memory
+_HTML_CACHE_SIZE = 100
+
 
 class BaseRequestHandler(webapp.RequestHandler):
   """Supplies a common template generation function.
@@ -77,8 +106,9 @@ class WikiPage(BaseRequestHandler):
   """Our one and only request handler.
 
   We first determine which page we are editing, using "MainPage" if no
-  page is specified in the URI. We then determine the mode we are in (view
-  or edit), choosing "view" by default.
+  page is specified in the URI. We then determine the mode we are in (view,
+  edit or history), choosing "view" by default. Earlier revisions of a page
+  are viewed with a revision parameter.
 
   POST requests to this handler handle edit operations, writing the new page
   to the datastore.
@@ -99,20 +129,31 @@ class WikiPage(BaseRequestHandler):
     if not page.entity:
       mode = 'edit'
     else:
-      modes = ['view', 'edit']
+      modes = ['view', 'edit', 'history']
       mode = self.request.get('mode')
       if not mode in modes:
         mode = 'view'
 
+    revision = self.request.get('revision')
+    if mode == 'view' and revision:
+      if revision.isdigit():
+        page = page.load_revision(int(revision))
+      else:
+        page = None
+      if not page:
+        self.error(404)
+        return
+
     # User must be logged in to edit
     if mode == 'edit' and not users.get_current_user():
       self.redirect(users.create_login_url(self.request.uri))
       return
 
     # Genertate the appropriate template
-    self.generate(mode + '.html', {
-      'page': page,
-    })
+    values = {'page': page}
+    if mode == 'history':
+      values['revisions'] = page.history(_HISTORY_SIZE)
+    self.generate(mode + '.html', values)
 
   def post(self, page_name):
     """Handle HTTP POST requests throughout the application, used to handle
@@ -139,18 +180,50 @@ class WikiPage(BaseRequestHandler):
     self.redirect(page.view_url())
 
 
+class MigratePages(webapp.RequestHandler):
+  """Migrates the pages saved before pages had key names.
+
+  Numeric ids sort before key names, so the legacy pages are the first ones
+  in key order. Each request migrates a batch of them; reload until all
+  pages are reported migrated, then set _LEGACY_PAGES to False.
+  """
+  def get(self):
+    query = datastore.Query('Page', keys_only=True)
+    query.Order('__key__')
+    keys = query.Get(_MIGRATE_BATCH_SIZE)
+    legacy = [key for key in keys if key.name() is None]
+    for entity in datastore.Get(legacy):
+      if entity:
+        Page.migrate(entity)
+    self.response.headers['Content-Type'] = 'text/plain'
+    if len(legacy) == _MIGRATE_BATCH_SIZE:
+      self.response.out.write('Migrated %d pages, reload to continue.\n' %
+                              len(legacy))
+    else:
+      self.response.out.write('Migrated %d pages, all pages are migrated.\n'
+                              % len(legacy))
+
+
 class Page(object):
   """Our abstraction for a Wiki page.
 
   We handle all datastore operations so that new pages are handled
   seamlessly. To create OR edit a page, just create a Page instance and
   clal save().
+
+  Each page is stored under a key name derived from its name, so it is
+  loaded with a get rather than a query. Its earlier revisions are stored
+  as Revision entities in its entity group, each as a delta from the
+  revision after it (see make_delta()). Pages saved before pages had key
+  names are migrated when they are loaded, or all at once by /_migrate.
   """
   def __init__(self, name, entity=None):
     self.name = name
     self.entity = entity
     if entity:
       self.content = entity['content']
+      self.revision = entity.get('revision')
+      self.latest_revision = self.revision
       if entity.has_key('user'):
         self.user = entity['user']
       else:
@@ -161,6 +234,8 @@ class Page(object):
       # New pages should start out with a simple title to get the user going
       now = datetime.datetime.now()
       self.content = '<h1>%s</h1>' % (cgi.escape(name),)
+      self.revision = None
+      self.latest_revision = None
       self.user = None
       self.created = now
       self.modified = now
@@ -174,7 +249,56 @@ class Page(object):
   def view_url(self):
     return '/' + self.name
 
+  def history_url(self):
+    return '/%s?mode=history' % (self.name,)
+
+  def revision_url(self):
+    return '/%s?revision=%d' % (self.name, self.revision)
+
+  def html_cache_key(self):
+    """Returns the key of the wikified content in the caches.
+
+    The key changes whenever the content changes, and whenever a page it
+    links to is created, so cached content is never stale.
+
+    Returns:
+      The key, or None if the content can't be cached because the page
+      hasn't been saved since its links started being recorded.
+    """
+    if not self.entity or self.revision is None:
+      return None
+    return '%s%s:%d:%d' % (_HTML_PREFIX, self.name, self.revision,
+                           self.entity.get('links_version', 0))
+
   def wikified_content(self):
+    """Returns our content wikified for HTML display, from cache if possible.
+
+    The wikified content is kept in memory in each instance and in memcache,
+    unless it's too large for a memcache item.
+
+    Returns:
+      The wikified version of the page contents.
+    """
+    key = self.html_cache_key()
+    if key:
+      content = _html_cache.get(key)
+      if content is not None:
+        return content
+      content = memcache.get(key)
+      if content is not None:
+        _html_cache.put(key, content)
+        return content
+
+    content = self.wikify()
+    if key:
+      _html_cache.put(key, content)
+      try:
+        memcache.set(key, content)
+      except ValueError, err:
+        logging.warning('Wikified %s too large to cache: %s', self.name, err)
+    return content
+
+  def wikify(self):
     """Applies our wiki transforms to our content for HTML display.
 
     We auto-link URLs, link WikiWords, and hide referers on links that
@@ -194,24 +318,154 @@ class Page(object):
     return content
 
   def save(self):
-    """Creates or edits this page in the datastore."""
-    now = datetime.datetime.now()
-    if self.entity:
-      entity = self.entity
+    """Creates or edits this page in the datastore.
+
+    The page and the revision it replaces are written in one transaction.
+    Along with the page, we record the WikiWords in it, as a backlink index,
+    and a revision number. When a page is created, the pages that link to it
+    are invalidated. The new wikified content is cached straight away.
+    """
+    if users.get_current_user():
+      user = users.get_current_user()
     else:
-      entity = datastore.Entity('Page')
-      entity['name'] = self.name
+      user = None
+    entity, created = datastore.RunInTransaction(
+        Page._save, Page.key_for(self.name), self.name, self.content, user)
+    self.entity = entity
+    self.revision = entity['revision']
+    self.latest_revision = self.revision
+    self.user = user
+    self.modified = entity['modified']
+    memcache.set(_EXISTS_PREFIX + self.name, 1)
+    if created:
+      Page.invalidate_backlinks(self.name, entity.key())
+    self.wikified_content()
+
+  @staticmethod
+  def _save(key, name, content, user):
+    now = datetime.datetime.now()
+    entities = []
+    try:
+      entity = datastore.Get(key)
+      created = False
+      revision = datastore.Entity('Revision', parent=key,
+                                  name='r%d' % entity.get('revision', 0))
+      revision['revision'] = entity.get('revision', 0)
+      revision['delta'] = datastore_types.Blob(
+          make_delta(content, entity['content']))
+      revision['modified'] = entity['modified']
+      if entity.has_key('user'):
+        revision['user'] = entity['user']
+      entities.append(revision)
+    except datastore_errors.EntityNotFoundError:
+      entity = datastore.Entity('Page', name=key.name())
+      entity['name'] = name
       entity['created'] = now
-    entity['content'] = datastore_types.Text(self.content)
+      created = True
+    entity['content'] = datastore_types.Text(content)
     entity['modified'] = now
-
-    if users.get_current_user():
-      entity['user'] = users.get_current_user()
+    entity['revision'] = entity.get('revision', 0) + 1
+    entity['links'] = sorted(set(
+        [match.group(0) for match in WIKIWORD.finditer(content)]))
+    if user:
+      entity['user'] = user
     elif entity.has_key('user'):
       del entity['user']
+    entities.append(entity)
+    datastore.Put(entities)
+    return entity, created
+
+  def load_revision(self, number):
+    """Returns this page as it was at the given revision.
+
+    The deltas of all the revisions after it are fetched with a single get
+    and applied to the current content, newest first.
 
+    Args:
+      number: The revision number.
+
+    Returns:
+      A Page, or None if the page has no such revision.
+    """
+    if self.revision is None or not 0 <= number <= self.revision:
+      return None
+    if number == self.revision:
+      return self
+    revisions = datastore.Get(
+        [Page.revision_key(self.entity.key(), n)
+         for n in range(self.revision - 1, number - 1, -1)])
+    content = self.content
+    for revision in revisions:
+      if revision is None:
+        return None
+      content = apply_delta(content, revision['delta'])
+    page = Page(self.name, self.entity)
+    page.content = content
+    page.revision = number
+    page.user = revision.get('user')
+    page.modified = revision['modified']
+    return page
+
+  def history(self, limit):
+    """Returns the latest revisions of this page, newest first.
+
+    Args:
+      limit: The maximum number of revisions to return.
+
+    Returns:
+      A list of Pages, without their contents, for the current revision and
+      the ones before it that are still stored.
+    """
+    if self.revision is None:
+      return []
+    history = [self]
+    first = max(self.revision - limit + 1, 0)
+    keys = [Page.revision_key(self.entity.key(), n)
+            for n in range(self.revision - 1, first - 1, -1)]
+    if keys:
+      for revision in datastore.Get(keys):
+        if revision is None:
+          break
+        page = Page(self.name, self.entity)
+        page.content = None
+        page.revision = revision['revision']
+        page.user = revision.get('user')
+        page.modified = revision['modified']
+        history.append(page)
+    return history
+
+  @staticmethod
+  def invalidate_backlinks(name, page_key):
+    """Changes the cache keys of the pages that link to the given page.
+
+    Each page is updated in its own transaction, so edits to it aren't lost.
+
+    Args:
+      name: The name of the page.
+      page_key: The key of the page, which needn't be invalidated itself.
+    """
+    query = datastore.Query('Page', {'links =': name}, keys_only=True)
+    for key in query.Run():
+      if key != page_key:
+        datastore.RunInTransaction(Page._increment_links_version, key)
+
+  @staticmethod
+  def _increment_links_version(key):
+    entity = datastore.Get(key)
+    entity['links_version'] = entity.get('links_version', 0) + 1
     datastore.Put(entity)
 
+  @staticmethod
+  def key_for(name):
+    """Returns the datastore key of the page with the given name."""
+    return datastore.Key.from_path('Page', _KEY_NAME_PREFIX + name)
+
+  @staticmethod
+  def revision_key(page_key, number):
+    """Returns the datastore key of a revision of the given page."""
+    return datastore.Key.from_path('Revision', 'r%d' % number,
+                                   parent=page_key)
+
   @staticmethod
   def load(name):
     """Loads the page with the given name.
@@ -221,18 +475,152 @@ class Page(object):
       the database. In that case, the Page object will be created when save()
       is called.
     """
-    query = datastore.Query('Page')
-    query['name ='] = name
-    entities = query.Get(1)
-    if len(entities) < 1:
-      return Page(name)
-    else:
-      return Page(name, entities[0])
+    try:
+      return Page(name, datastore.Get(Page.key_for(name)))
+    except datastore_errors.EntityNotFoundError:
+      pass
+    if _LEGACY_PAGES:
+      query = datastore.Query('Page')
+      query['name ='] = name
+      entities = query.Get(1)
+      if entities and entities[0].key().name() is None:
+        return Page(name, Page.migrate(entities[0]))
+    return Page(name)
+
+  @staticmethod
+  def migrate(legacy):
+    """Moves a page saved before pages had key names to its key name.
+
+    If the page has already been moved, the legacy entity is a duplicate,
+    and it is just deleted.
+
+    Args:
+      legacy: The entity of the page, which has a numeric id.
+
+    Returns:
+      The entity of the page under its key name.
+    """
+    entity = datastore.RunInTransaction(Page._migrate, legacy)
+    datastore.Delete(legacy.key())
+    return entity
+
+  @staticmethod
+  def _migrate(legacy):
+    key = Page.key_for(legacy['name'])
+    try:
+      return datastore.Get(key)
+    except datastore_errors.EntityNotFoundError:
+      entity = datastore.Entity('Page', name=key.name())
+      entity.update(legacy)
+      datastore.Put(entity)
+      return entity
 
   @staticmethod
   def exists(name):
     """Returns true if the page with the given name exists in the datastore."""
-    return Page.load(name).entity
+    return name in Page.existing([name])
+
+  @staticmethod
+  def existing(names):
+    """Determines which of the given pages exist.
+
+    Whether each page exists is cached in memcache, so this is usually a
+    single memcache call. The pages memcache doesn't know about are fetched
+    by key with a single batch get, and the answers are added to memcache.
+    save() records that a page exists, so those answers never go stale.
+
+    Until all pages are migrated, the pages that aren't found by key are
+    looked up with keys only queries, which are all started before any
+    result is read.
+
+    Args:
+      names: An iterable of page names.
+
+    Returns:
+      The set of the names of the pages that exist.
+    """
+    names = set(names)
+    if not names:
+      return set()
+    cached = memcache.get_multi(list(names), key_prefix=_EXISTS_PREFIX)
+    existing = set([name for name, exists in cached.items() if exists])
+    missing = [name for name in names if name not in cached]
+    if missing:
+      found = {}
+      entities = datastore.Get([Page.key_for(name) for name in missing])
+      for name, entity in zip(missing, entities):
+        found[name] = entity and 1 or 0
+      if _LEGACY_PAGES:
+        legacy = [name for name in missing if not found[name]]
+        results = []
+        for name in legacy:
+          query = datastore.Query('Page', {'name =': name}, keys_only=True)
+          results.append(query.Run(limit=1))
+        for name, result in zip(legacy, results):
+          for key in result:
+            found[name] = 1
+      for name in missing:
+        if found[name]:
+          existing.add(name)
+      # add rather than set, so we never overwrite what save() recorded
+      memcache.add_multi(found, key_prefix=_EXISTS_PREFIX)
+    return existing
+
+
+# Splits page contents into the tags, words and whitespace make_delta() diffs
+_DELTA_TOKENS = re.compile(r'<[^>]*>|[^<\s]+|\s+|<')
+
+
+def make_delta(new, old):
+  """Returns a compact delta that rebuilds old content from new content.
+
+  The contents are diffed as sequences of tags, words and whitespace. The
+  delta lists the pieces of the old content in order, each either a
+  (start, end) range of the new content or literal text, and is pickled and
+  compressed. Small contents are cheaper to store whole, in which case the
+  delta is just the old content.
+
+  Args:
+    new: The new content.
+    old: The old content.
+
+  Returns:
+    The delta, as a string for apply_delta().
+  """
+  new_tokens = _DELTA_TOKENS.findall(new)
+  old_tokens = _DELTA_TOKENS.findall(old)
+  offsets = [0]
+  for token in new_tokens:
+    offsets.append(offsets[-1] + len(token))
+  pieces = []
+  matcher = difflib.SequenceMatcher(None, new_tokens, old_tokens)
+  for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+    if tag == 'equal':
+      pieces.append((offsets[i1], offsets[i2]))
+    elif j1 < j2:
+      pieces.append(''.join(old_tokens[j1:j2]))
+  return min(zlib.compress(pickle.dumps(pieces, pickle.HIGHEST_PROTOCOL)),
+             zlib.compress(pickle.dumps([old], pickle.HIGHEST_PROTOCOL)),
+             key=len)
+
+
+def apply_delta(new, delta):
+  """Rebuilds old content from new content and a delta from make_delta().
+
+  Args:
+    new: The new content.
+    delta: The delta.
+
+  Returns:
+    The old content.
+  """
+  parts = []
+  for piece in pickle.loads(zlib.decompress(delta)):
+    if isinstance(piece, tuple):
+      parts.append(new[piece[0]:piece[1]])
+    else:
+      parts.append(piece)
+  return u''.join(parts)
 
 
 class Transform(object):
@@ -269,17 +657,86 @@ class Transform(object):
     return ''.join(parts)
 
 
+class LruCache(object):
+  """A least recently used cache holding a fixed number of values.
+
+  Entries are kept in a dict and a circular doubly linked list of
+  [prev, next, key, value] links, most recently used last.
+  """
+  def __init__(self, size):
+    self.size = size
+    self._links = {}
+    self._root = []
+    self._root[:] = [self._root, self._root, None, None]
+    self._lock = threading.Lock()
+
+  def get(self, key):
+    """Returns the value for key, or None if it isn't cached."""
+    self._lock.acquire()
+    try:
+      link = self._links.get(key)
+      if link is None:
+        return None
+      self._unlink(link)
+      self._append(link)
+      return link[3]
+    finally:
+      self._lock.release()
+
+  def put(self, key, value):
+    """Caches value under key, evicting the least recently used value."""
+    self._lock.acquire()
+    try:
+      link = self._links.pop(key, None)
+      if link is not None:
+        self._unlink(link)
+      elif len(self._links) >= self.size:
+        oldest = self._root[1]
+        self._unlink(oldest)
+        del self._links[oldest[2]]
+      link = [None, None, key, value]
+      self._append(link)
+      self._links[key] = link
+    finally:
+      self._lock.release()
+
+  def _unlink(self, link):
+    link[0][1] = link[1]
+    link[1][0] = link[0]
+
+  def _append(self, link):
+    last = self._root[0]
+    link[0] = last
+    link[1] = self._root
+    last[1] = link
+    self._root[0] = link
+
+
+_html_cache = LruCache(_HTML_CACHE_SIZE)
+
+# What a WikiWord looks like
+WIKIWORD = re.compile(r'[A-Z][a-z]+([A-Z][a-z]+)+')
+
+
 class WikiWords(Transform):
   """Translates WikiWords to links.
 
   We look up all words, and we only link those words that currently exist.
+  All the words in the content are looked up together before any is
+  replaced.
   """
   def __init__(self):
-    self.regexp = re.compile(r'[A-Z][a-z]+([A-Z][a-z]+)+')
+    self.regexp = WIKIWORD
+    self.existing = set()
+
+  def run(self, content):
+    self.existing = Page.existing(
+        [match.group(0) for match in self.regexp.finditer(content)])
+    return Transform.run(self, content)
 
   def replace(self, match):
     wikiword = match.group(0)
-    if Page.exists(wikiword):
+    if wikiword in self.existing:
       return '<a class="wikiword" href="/%s">%s</a>' % (wikiword, wikiword)
     else:
       return wikiword
@@ -310,7 +767,8 @@ class HideReferers(Transform):
 
 
 def main():
-  application = webapp.WSGIApplication([('/(.*)', WikiPage)], debug=_DEBUG)
+  application = webapp.WSGIApplication([('/_migrate', MigratePages),
+                                        ('/(.*)', WikiPage)], debug=_DEBUG)
   run_wsgi_app(application)
 
 
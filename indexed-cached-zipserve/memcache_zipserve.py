@@ -24,15 +24,20 @@ his implementation of zipserve which served as a reference as I wrote this.
 
   MemcachedZipHandler: Class that serves request
   create_handler: method to create instance of MemcachedZipHandler
+  LruCache: Class for the bounded, in-instance cache in front of memcache
 """
 
 __author__ = 'j.c@google.com (Justin Mattson)'
 
+import calendar
 import email.Utils
 import logging
 import mimetypes
+import struct
+import threading
 import time
 import zipfile
+import zlib
 
 from google.appengine.api import memcache
 from google.appengine.ext import webapp
@@ -84,18 +89,115 @@ def create_handler(zip_files, max_age=None, public=None):
   return HandlerWrapper
 
 
+class LruCache(object):
+  """A least recently used cache, bounded by the total size of its values.
+
+  Entries are kept in a dict and a circular doubly linked list of
+  [prev, next, key, value, size] links, most recently used last, so that
+  lookups, insertions and evictions are all O(1).
+  """
+
+  def __init__(self, max_bytes, max_item_bytes=None):
+    """Create an empty cache.
+
+    Args:
+      max_bytes: The most bytes of values (plus keys) to hold
+      max_item_bytes: Larger values are not cached. Defaults to an eighth of
+          max_bytes
+    """
+    self.max_bytes = max_bytes
+    if max_item_bytes is None:
+      max_item_bytes = max_bytes / 8
+    self.max_item_bytes = max_item_bytes
+    self.size = 0
+    self._links = {}
+    self._root = []
+    self._root[:] = [self._root, self._root, None, None, 0]
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._links)
+
+  def get(self, key):
+    """Return the value for key, or None if it is not cached."""
+    self._lock.acquire()
+    try:
+      link = self._links.get(key)
+      if link is None:
+        return None
+      self._Unlink(link)
+      self._Append(link)
+      return link[3]
+    finally:
+      self._lock.release()
+
+  def put(self, key, value, size):
+    """Cache value under key, evicting least recently used entries.
+
+    Args:
+      key: The key to store the value under
+      value: The value to store
+      size: The number of bytes to count value as
+    """
+    size += len(key)
+    if size > self.max_item_bytes:
+      return
+    self._lock.acquire()
+    try:
+      link = self._links.pop(key, None)
+      if link is not None:
+        self._Unlink(link)
+        self.size -= link[4]
+      while self.size + size > self.max_bytes and self._links:
+        oldest = self._root[1]
+        self._Unlink(oldest)
+        del self._links[oldest[2]]
+        self.size -= oldest[4]
+      link = [None, None, key, value, size]
+      self._Append(link)
+      self._links[key] = link
+      self.size += size
+    finally:
+      self._lock.release()
+
+  def _Unlink(self, link):
+    link[0][1] = link[1]
+    link[1][0] = link[0]
+
+  def _Append(self, link):
+    last = self._root[0]
+    link[0] = last
+    link[1] = self._root
+    last[1] = link
+    self._root[0] = link
+
+
 class MemcachedZipHandler(webapp.RequestHandler):
   """Handles get requests for a given URL.
 
   Serves a GET request from a series of zip files. As files are served they are
   put into memcache, which is much faster than retreiving them from the zip
-  source file again. It also uses considerably fewer CPU cycles.
+  source file again. It also uses considerably fewer CPU cycles. In front of
+  memcache sits a bounded LRU cache in the instance's own memory, so the hot
+  files that make up most requests are served without any RPC at all.
   """
   zipfile_cache = {}                # class cache of source zip files
+  index_cache = {}                  # class cache of zip file indexes, and
+                                    # when incomplete ones are rebuilt
+  LOCAL_CACHE_BYTES = 8 * 1024 * 1024  # size of the in-instance cache
+  local_cache = LruCache(LOCAL_CACHE_BYTES)  # class cache of file contents
   MAX_AGE = 600                     # max client-side cache lifetime
   PUBLIC = True                     # public cache setting
   CACHE_PREFIX = "cache://"         # memcache key prefix for actual URLs
-  NEG_CACHE_PREFIX = "noncache://"  # memcache key prefix for non-existant URL
+  NEG_CACHE_BYTES = 256 * 1024      # size of the in-instance negative cache
+  NEG_CACHE_TTL = 600               # secs a URL stays in the negative cache
+  negative_cache = LruCache(NEG_CACHE_BYTES)  # class cache of missing URLs
+  GZIP_CACHE_PREFIX = "gzip://"     # memcache key prefix for gzipped URLs
+  MEMCACHE_CHUNK_BYTES = 1000000 - 4096  # memcache item limit, less key room
+  COMPRESS_CACHE = True             # zlib compress data stored in memcache
+  SERVE_DEFLATED = False            # serve the zips' deflate streams as gzip
+  etag = None                       # ETag of the file being served
+  last_modified = None              # modification time of the file, in secs
 
   def TrueGet(self, name):
     """The top-level entry point to serving requests.
@@ -111,7 +213,35 @@ class MemcachedZipHandler(webapp.RequestHandler):
     """
     name = self.PreprocessUrl(name)
 
-    # see if we have the page in the memcache
+    # the index has what's needed to answer conditional requests, so files
+    # that the client already has are never loaded
+    info = self.GetFileInfo(name)
+    if info is None and self.IsIndexComplete():
+      self.Write404Error()
+      return
+    gzipped = False
+    if self.SERVE_DEFLATED:
+      self.response.headers['Vary'] = 'Accept-Encoding'
+      gzipped = (info is not None and
+                 info.compress_type == zipfile.ZIP_DEFLATED and
+                 self.AcceptsGzip())
+    if info is not None:
+      self.SetValidatorHeaders(info, gzipped)
+      if self.IsNotModified():
+        self.response.set_status(304)
+        self.SetCachingHeaders()
+        return
+
+    if gzipped:
+      resp_data = self.GetGzipped(name)
+      if resp_data is not None:
+        self.response.headers['Content-Encoding'] = 'gzip'
+        self.WriteResponse(name, resp_data, byte_ranges=False)
+        return
+      self.SetValidatorHeaders(info, False)
+
+    # see if we have the page in the memcache. The negative cache is only
+    # needed if a zip file couldn't be opened and is missing from the index
     resp_data = self.GetFromCache(name)
     if resp_data is None:
       logging.info('Cache miss for %s', name)
@@ -132,11 +262,142 @@ class MemcachedZipHandler(webapp.RequestHandler):
         self.Write404Error()
         return
 
+    self.WriteResponse(name, resp_data)
+
+  def WriteResponse(self, name, resp_data, byte_ranges=True):
+    """Write the headers and body of a successful response.
+
+    Args:
+      name: URL requested
+      resp_data: The body to send
+      byte_ranges: Whether to honor a Range header
+
+    Returns:
+      None
+    """
+    byte_range = None
+    if byte_ranges:
+      self.response.headers['Accept-Ranges'] = 'bytes'
+      byte_range = self.ParseRange(len(resp_data))
+      if byte_range is not None and byte_range[0] >= len(resp_data):
+        self.response.set_status(416)
+        self.response.headers['Content-Range'] = 'bytes */%d' % len(resp_data)
+        return
+
     content_type, encoding = mimetypes.guess_type(name)
     if content_type:
       self.response.headers['Content-Type'] = content_type
     self.SetCachingHeaders()
-    self.response.out.write(resp_data)
+    if byte_range is None:
+      self.response.out.write(resp_data)
+    else:
+      first, last = byte_range
+      self.response.set_status(206)
+      self.response.headers['Content-Range'] = 'bytes %d-%d/%d' % (
+          first, last, len(resp_data))
+      self.response.out.write(resp_data[first:last + 1])
+
+  def SetValidatorHeaders(self, info, gzipped):
+    """Set the ETag and Last-Modified headers of a file.
+
+    The ETag is made from the CRC and size of the file, the Last-Modified
+    time from its modification time in the zip file, which has no time zone
+    and is taken to be UTC.
+
+    Args:
+      info: the ZipInfo of the file, from the index
+      gzipped: Whether the file is served gzipped, which changes its ETag
+
+    Returns:
+      None
+    """
+    self.etag = '"%08x-%x%s"' % (info.CRC & 0xffffffffL, info.file_size,
+                                 gzipped and '-gzip' or '')
+    self.last_modified = calendar.timegm(tuple(info.date_time) + (0, 0, 0))
+    self.response.headers['ETag'] = self.etag
+    self.response.headers['Last-Modified'] = email.Utils.formatdate(
+        self.last_modified, usegmt=True)
+
+  def IsNotModified(self):
+    """Whether the client's copy of the file is current.
+
+    If-None-Match takes precedence over If-Modified-Since, as in RFC 2616.
+
+    Returns:
+      True if a 304 Not Modified response should be sent
+    """
+    if_none_match = self.request.headers.get('If-None-Match')
+    if if_none_match is not None:
+      for etag in if_none_match.split(','):
+        etag = etag.strip()
+        if etag.startswith('W/'):
+          etag = etag[2:]
+        if etag == '*' or etag == self.etag:
+          return True
+      return False
+    return self.IsNotModifiedSince(
+        self.request.headers.get('If-Modified-Since'))
+
+  def IsNotModifiedSince(self, http_date):
+    """Whether the file has not been modified since an HTTP date."""
+    if not http_date or self.last_modified is None:
+      return False
+    parsed_date = email.Utils.parsedate_tz(http_date)
+    if parsed_date is None:
+      return False
+    try:
+      return self.last_modified <= email.Utils.mktime_tz(parsed_date)
+    except (OverflowError, ValueError):
+      return False
+
+  def ParseRange(self, length):
+    """Parse the Range header of the request.
+
+    Only a single byte range is supported, requests for several ranges get
+    the whole file, as HTTP allows. So does a request whose If-Range doesn't
+    match the file.
+
+    Args:
+      length: The length of the file
+
+    Returns:
+      None to send the whole file, or the (first, last) positions of the
+      bytes to send. If first is not less than length, the range can't be
+      satisfied.
+    """
+    range_header = self.request.headers.get('Range', '')
+    if not range_header.startswith('bytes='):
+      return None
+    if_range = self.request.headers.get('If-Range')
+    if if_range is not None:
+      if if_range.startswith('"') or if_range.startswith('W/'):
+        if if_range != self.etag:
+          return None
+      elif not self.IsNotModifiedSince(if_range):
+        return None
+
+    byte_ranges = range_header[len('bytes='):].split(',')
+    if len(byte_ranges) != 1:
+      return None
+    try:
+      first, last = [part.strip() for part in byte_ranges[0].split('-')]
+      if not first:
+        suffix_length = int(last)
+        if suffix_length == 0:
+          return (length, length)
+        return (max(0, length - suffix_length), length - 1)
+      first = int(first)
+      if last:
+        last = int(last)
+        if last < first:
+          return None
+      else:
+        last = length - 1
+    except ValueError:
+      return None
+    if first >= length:
+      return (first, first)
+    return (first, min(last, length - 1))
 
   def PreprocessUrl(self, name):
     """Any preprocessing work on the URL when it comes it.
@@ -160,46 +421,164 @@ class MemcachedZipHandler(webapp.RequestHandler):
   def GetFromStore(self, file_path):
     """Retrieve file from zip files.
 
-    Get the file from the source, it must not have been in the memcache. If
-    possible, we'll use the zip file index to quickly locate where the file
-    should be found. (See MapToFileArchive documentation for assumptions about
-    file ordering.) If we don't have an index or don't find the file where the
-    index says we should, look through all the zip files to find it.
+    Get the file from the source, it must not have been in the memcache. The
+    index of all the zip files (see GetIndex) says which archive holds the
+    file, or that none does, so no archive is searched.
 
     Args:
       file_path: the file that we're looking for
 
     Returns:
-      The contents of the requested file
+      The contents of the requested file, or None if it does not exist
     """
-    resp_data = None
-    file_itr = iter(self.zipfilenames)
+    entry = self.GetIndex().get(file_path)
+    if entry is None:
+      return None
+    archive_name, info = entry
+    zip_archive = self.LoadZipFile(archive_name)
+    if not zip_archive:
+      return None
+    try:
+      resp_data = zip_archive.read(info.filename)
+    except (RuntimeError, zipfile.BadZipfile), err:
+      logging.error('Can\'t read %s from %s, cause: %s', file_path,
+                    archive_name, err)
+      return None
+    logging.info('%s read from %s', file_path, archive_name)
+    return resp_data
 
-    # check the index, if we have one, to see what archive the file is in
-    archive_name = self.MapFileToArchive(file_path)
-    if not archive_name:
-      archive_name = file_itr.next()[0]
-    
-    while resp_data is None and archive_name:
+  def GetArchiveNames(self):
+    """Get the names of the zip files, in the order they are searched."""
+    return tuple([target[0] for target in self.zipfilenames])
+
+  def IsIndexComplete(self):
+    """Whether the index covers every zip file, so it knows all files."""
+    cached = self.index_cache.get(self.GetArchiveNames())
+    return cached is not None and cached[1] is None
+
+  def GetIndex(self):
+    """Get the index of every file in the zip files.
+
+    The index is built from the zip files' central directories, which are
+    read anyway when they are opened, the first time it is needed, and then
+    kept for the life of the instance. If a zip file can't be opened, the
+    index of the others is kept too, marked incomplete, and rebuilt after
+    NEG_CACHE_TTL seconds, like the negative cache entries of its files.
+
+    Returns:
+      A dict mapping each file path to an (archive name, ZipInfo) tuple. If
+      several archives hold the same path, the first one listed wins. The
+      ZipInfo has the file's CRC, size and modification time.
+    """
+    archive_names = self.GetArchiveNames()
+    cached = self.index_cache.get(archive_names)
+    if cached is not None:
+      index, rebuild_at = cached
+      if rebuild_at is None or rebuild_at > time.time():
+        return index
+    index = {}
+    rebuild_at = None
+    for archive_name in archive_names:
       zip_archive = self.LoadZipFile(archive_name)
-      if zip_archive:
-
-        # we expect some lookups will fail, and that's okay, 404s will deal
-        # with that
-        try:
-          resp_data = zip_archive.read(file_path)
-        except (KeyError, RuntimeError), err:
-          # no op
-          x = False
-        if resp_data is not None:
-          logging.info('%s read from %s', file_path, archive_name)
-          
-      try:
-        archive_name = file_itr.next()[0]
-      except (StopIteration), err:
-        archive_name = False
+      if not zip_archive:
+        rebuild_at = time.time() + self.NEG_CACHE_TTL
+        continue
+      for info in zip_archive.infolist():
+        if not info.filename.endswith('/'):
+          index.setdefault(info.filename, (archive_name, info))
+    self.index_cache[archive_names] = (index, rebuild_at)
+    return index
+
+  def GetFileInfo(self, file_path):
+    """Get the ZipInfo of a file, or None if no zip file holds it."""
+    entry = self.GetIndex().get(file_path)
+    if entry is None:
+      return None
+    return entry[1]
+
+  def AcceptsGzip(self):
+    """Whether the client sent an Accept-Encoding that allows gzip."""
+    accept_encoding = self.request.headers.get('Accept-Encoding', '')
+    for coding in accept_encoding.split(','):
+      params = coding.strip().split(';')
+      if params[0].strip().lower() not in ('gzip', 'x-gzip'):
+        continue
+      for param in params[1:]:
+        param = param.replace(' ', '')
+        if param in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+          return False
+      return True
+    return False
+
+  def GetGzipped(self, file_path):
+    """Get a file as a gzip stream, without decompressing and compressing it.
+
+    Files stored deflated in their zip file are served as the zip file's own
+    deflate stream, wrapped in a gzip header and a trailer built from the
+    CRC and size in the zip file index. Note that the App Engine front end
+    manages Content-Encoding itself and may strip it or decompress the
+    response for some clients, which is why SERVE_DEFLATED is off by default.
 
-    return resp_data
+    Args:
+      file_path: the file that we're looking for
+
+    Returns:
+      The gzip stream, or None if the file does not exist or is not deflated
+    """
+    key = "%s%s" % (self.GZIP_CACHE_PREFIX, file_path)
+    gzip_data = self.GetFromTwoTierCache(key)
+    if gzip_data is not None:
+      return gzip_data
+
+    entry = self.GetIndex().get(file_path)
+    if entry is None:
+      return None
+    archive_name, info = entry
+    if info.compress_type != zipfile.ZIP_DEFLATED:
+      return None
+    deflate_data = self.ReadDeflateStream(archive_name, info)
+    if deflate_data is None:
+      return None
+    # header: magic, deflate, no flags, no mtime, no extra flags, unknown OS
+    gzip_data = ''.join(['\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff',
+                         deflate_data,
+                         struct.pack('<LL', info.CRC & 0xffffffffL,
+                                     info.file_size & 0xffffffffL)])
+    self.StoreInCache(key, gzip_data)
+    return gzip_data
+
+  def ReadDeflateStream(self, archive_name, info):
+    """Read the still compressed data of a file in a zip file.
+
+    Args:
+      archive_name: the zip file holding the file
+      info: the ZipInfo of the file, from the index
+
+    Returns:
+      The raw deflate stream, or None if it can't be read
+    """
+    try:
+      archive = open(archive_name, 'rb')
+      try:
+        archive.seek(info.header_offset)
+        header = archive.read(30)
+        if len(header) != 30 or header[:4] != 'PK\x03\x04':
+          raise zipfile.BadZipfile('bad local file header')
+        # the local header's name and extra field lengths can differ from
+        # the central directory's, so skip the ones in the local header
+        name_length, extra_length = struct.unpack('<HH', header[26:30])
+        archive.seek(name_length + extra_length, 1)
+        deflate_data = archive.read(info.compress_size)
+      finally:
+        archive.close()
+    except (IOError, zipfile.BadZipfile), err:
+      logging.error('Can\'t read %s from %s, cause: %s', info.filename,
+                    archive_name, err)
+      return None
+    if len(deflate_data) != info.compress_size:
+      logging.error('Short read of %s from %s', info.filename, archive_name)
+      return None
+    return deflate_data
 
   def LoadZipFile(self, zipfilename):
     """Convenience method to load zip file.
@@ -227,31 +606,23 @@ class MemcachedZipHandler(webapp.RequestHandler):
     return zip_archive
 
   def MapFileToArchive(self, file_path):
-    """Given a file name, determine what archive it should be in.
+    """Given a file name, determine what archive it is in.
 
-    This method makes two critical assumptions.
-    (1) The zip files passed as an argument to the handler, if concatenated
-        in that same order, would result in a total ordering
-        of all the files. See (2) for ordering type.
-    (2) Upper case letters before lower case letters. The traversal of a
-        directory tree is depth first. A parent directory's files are added
-        before the files of any child directories
+    This used to rely on the zip files being listed in an order where the
+    last file of each (the second member of its mapping) could be compared
+    with CompareFilenames. The index makes that unnecessary, but the
+    mappings are still accepted.
 
     Args:
       file_path: the file to be mapped to an archive
 
     Returns:
-      The name of the archive where we expect the file to be
+      The name of the archive holding the file, or None if none does
     """
-    num_archives = len(self.zipfilenames)
-    while num_archives > 0:
-      target = self.zipfilenames[num_archives - 1]
-      if len(target) > 1:
-        if self.CompareFilenames(target[1], file_path) >= 0:
-          return target[0]
-      num_archives -= 1
-
-    return None
+    entry = self.GetIndex().get(file_path)
+    if entry is None:
+      return None
+    return entry[0]
 
   def CompareFilenames(self, file1, file2):
     """Determines whether file1 is lexigraphically 'before' file2.
@@ -325,7 +696,7 @@ class MemcachedZipHandler(webapp.RequestHandler):
     self.response.headers['Cache-Control'] = ', '.join(cache_control)
 
   def GetFromCache(self, filename):
-    """Get file from memcache, if available.
+    """Get file from the instance cache or memcache, if available.
 
     Args:
       filename: The URL of the file to return
@@ -333,15 +704,71 @@ class MemcachedZipHandler(webapp.RequestHandler):
     Returns:
       The content of the file
     """
-    return memcache.get("%s%s" % (self.CACHE_PREFIX, filename))
+    return self.GetFromTwoTierCache("%s%s" % (self.CACHE_PREFIX, filename))
+
+  def GetFromTwoTierCache(self, key):
+    """Get a value from the instance cache, falling back to memcache.
+
+    Values found in memcache are added to the instance cache.
+
+    Args:
+      key: The memcache key of the value
+
+    Returns:
+      The value, or None if neither cache has it
+    """
+    value = self.local_cache.get(key)
+    if value is None:
+      value = memcache.get(key)
+      if isinstance(value, tuple):
+        value = self.ReadManifest(key, value)
+      if value is not None:
+        self.StoreInLocalCache(key, value)
+    return value
+
+  def ReadManifest(self, key, manifest):
+    """Reassemble a value that StoreInCache compressed or split into chunks.
+
+    Args:
+      key: The memcache key of the manifest
+      manifest: A (compressed, chunk count, inline data) tuple. With a chunk
+          count of 0 the data is in the manifest itself, otherwise it is in
+          the chunks, stored under the key followed by '#' and the number
+
+    Returns:
+      The value, or None if a chunk has been evicted or is corrupt
+    """
+    compressed, chunk_count, data = manifest
+    if chunk_count:
+      chunk_keys = ['%s#%d' % (key, i) for i in xrange(chunk_count)]
+      chunks = memcache.get_multi(chunk_keys)
+      if len(chunks) != chunk_count:
+        logging.info('Chunks of %s missing from memcache', key)
+        return None
+      data = ''.join([chunks[chunk_key] for chunk_key in chunk_keys])
+    if compressed:
+      try:
+        data = zlib.decompress(data)
+      except zlib.error, err:
+        logging.error('Corrupt data for %s in memcache: %s', key, err)
+        return None
+    return data
+
+  def StoreInLocalCache(self, key, value):
+    """Store a value in the instance cache.
+
+    Args:
+      key: The memcache key of the value
+      value: A string
+
+    Returns:
+      None
+    """
+    self.local_cache.put(key, value, len(value))
 
   def StoreOrUpdateInCache(self, filename, data):
     """Store data in the cache.
 
-    Store a piece of data in the memcache. Memcache has a maximum item size of
-    1*10^6 bytes. If the data is too large, fail, but log the failure. Future
-    work will consider compressing the data before storing or chunking it
-
     Args:
       filename: the name of the file to store
       data: the data of the file
@@ -349,9 +776,50 @@ class MemcachedZipHandler(webapp.RequestHandler):
     Returns:
       None
     """
+    self.StoreInCache("%s%s" % (self.CACHE_PREFIX, filename), data)
+
+  def StoreInCache(self, key, data):
+    """Store data in the instance cache and memcache.
+
+    Memcache has a maximum item size of 1*10^6 bytes. Data is zlib compressed
+    if COMPRESS_CACHE is set and that makes it smaller. If it is still too
+    large for one item, it is split into chunks stored with one set_multi,
+    and a manifest saying how to reassemble them (see ReadManifest) is stored
+    under the key. Small, uncompressed data is stored as is.
+
+    Args:
+      key: The memcache key to store the data under
+      data: The data to store
+
+    Returns:
+      None
+    """
+    self.StoreInLocalCache(key, data)
+    compressed = False
+    if self.COMPRESS_CACHE:
+      compressed_data = zlib.compress(data)
+      if len(compressed_data) < len(data):
+        data = compressed_data
+        compressed = True
+
+    chunk_size = self.MEMCACHE_CHUNK_BYTES
     try:
-      if not memcache.add("%s%s" % (self.CACHE_PREFIX, filename), data):
-        memcache.replace("%s%s" % (self.CACHE_PREFIX, filename), data)
+      if len(data) <= chunk_size:
+        if compressed:
+          data = (True, 0, data)
+        if not memcache.add(key, data):
+          memcache.replace(key, data)
+        return
+
+      # store the chunks first, so a reader never finds the manifest of
+      # chunks that were not stored
+      chunks = {}
+      for offset in xrange(0, len(data), chunk_size):
+        chunks['%s#%d' % (key, len(chunks))] = data[offset:offset + chunk_size]
+      if memcache.set_multi(chunks):
+        logging.warning('Could not store all chunks of %s', key)
+        return
+      memcache.set(key, (compressed, len(chunks), None))
     except (ValueError), err:
       logging.warning("Data size too large to cache\n%s" % err)
 
@@ -363,8 +831,10 @@ class MemcachedZipHandler(webapp.RequestHandler):
   def StoreInNegativeCache(self, filename):
     """If a non-existant URL is accessed, cache this result as well.
 
-    Future work should consider setting a maximum negative cache size to
-    prevent it from from negatively impacting the real cache.
+    The negative cache is a bounded LRU cache in the instance's memory, so
+    requests for random URLs can't push real files out of memcache. Entries
+    expire after NEG_CACHE_TTL seconds, in case the missing zip file becomes
+    readable.
 
     Args:
       filename: URL to add ot negative cache
@@ -372,7 +842,7 @@ class MemcachedZipHandler(webapp.RequestHandler):
     Returns:
       None
     """
-    memcache.add("%s%s" % (self.NEG_CACHE_PREFIX, filename), -1)
+    self.negative_cache.put(filename, time.time() + self.NEG_CACHE_TTL, 0)
 
   def GetFromNegativeCache(self, filename):
     """Retrieve from negative cache.
@@ -381,10 +851,12 @@ class MemcachedZipHandler(webapp.RequestHandler):
       filename: URL to retreive
 
     Returns:
-      The file contents if present in the negative cache.
+      -1 if the URL is in the negative cache and has not expired, else None
     """
-    return memcache.get("%s%s" % (self.NEG_CACHE_PREFIX, filename))
-
+    expires = self.negative_cache.get(filename)
+    if expires is None or expires < time.time():
+      return None
+    return -1
 
 def main():
   application = webapp.WSGIApplication([('/([^/]+)/(.*)',
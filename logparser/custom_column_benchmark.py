@@ -0,0 +1,137 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2010 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Micro-benchmark of logparser custom column cost over a synthetic log.
+
+Parses a synthetic request log with 0, 1, 5, 10 and 20 custom columns, both
+the way logparser used to (re.search per column per applog line) and with
+the precompiled CustomColumns, and reports the parse time per line and the
+extra cost of each custom column.
+
+Example:
+
+  custom_column_benchmark.py --requests 20000
+"""
+# pylint: disable-msg=C6409
+
+import optparse
+import random
+import re
+import time
+
+import logparser
+
+
+REQUEST_LINE = ('10.1.2.%d - - [18/Oct/2010:12:%02d:%02d -0700] '
+                '"GET /page/%d HTTP/1.1" 200 %d "-" "Mozilla/5.0" '
+                '"app.appspot.com" ms=%d cpu_ms=%d api_cpu_ms=0 '
+                'cpm_usd=0.%03d\n')
+APPLOG_LINES = (
+    '\t1:1286325423.%06d Found %d widgets\n',
+    '\t0:1286325423.%06d Fetched entity in %d ms\n',
+    '\t2:1286325423.%06d Cache miss for key %d\n',
+    '\t1:1286325423.%06d Rendered template with %d items\n',
+    '\t3:1286325423.%06d DeadlineExceededError after %d ms\n',
+)
+
+
+def synthetic_log(request_count, seed=0):
+  """Return a list of lines of a synthetic request log with applogs."""
+  rand = random.Random(seed)
+  lines = []
+  for i in xrange(request_count):
+    lines.append(REQUEST_LINE % (
+        i % 256, i / 60 % 60, i % 60, i % 500, rand.randint(0, 9999),
+        rand.randint(1, 5000), rand.randint(1, 3000), rand.randint(1, 999)))
+    for _ in xrange(rand.randint(0, 4)):
+      lines.append(rand.choice(APPLOG_LINES) % (i, rand.randint(1, 999)))
+  return lines
+
+
+def custom_columns(count):
+  """Return a dict of count custom columns, a few of which match the log."""
+  columns = {
+      'widgets': r'^1:[0-9.]+ Found ([0-9]+) widgets',
+      'fetch_ms': r'Fetched entity in ([0-9]+) ms',
+      'template_items': r'Rendered template with ([0-9]+) items',
+  }
+  for i in xrange(len(columns), count):
+    columns['missing%d' % i] = r'Handler %d finished in ([0-9]+) ms' % i
+  return dict(sorted(columns.items())[:count])
+
+
+def parse_line_uncompiled(line, custom_columns):
+  """parse_line as it was, running re.search for every column."""
+  if not line.startswith('\t'):
+    return logparser.parse_line(line, {})
+  results = {}
+  applog = line.strip()
+  results['applog'] = applog
+  for column, regexp in custom_columns.iteritems():
+    match = re.search(regexp, applog)
+    if match:
+      results[column] = match.group(1)
+  return results
+
+
+def time_parse(parse, lines, columns, repeat):
+  """Return the best time over repeat runs of parse over every line."""
+  best = None
+  for _ in xrange(repeat):
+    start = time.time()
+    for line in lines:
+      parse(line, columns)
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
+
+
+def main():
+  """Run the benchmark and print a table of results."""
+  parser = optparse.OptionParser()
+  parser.add_option('--requests', dest='requests', type='int', default=20000,
+                    help='Synthetic requests to parse (default: %default).')
+  parser.add_option('--repeat', dest='repeat', type='int', default=3,
+                    help='Best of this many runs (default: %default).')
+  options, _ = parser.parse_args()
+
+  lines = synthetic_log(options.requests)
+  print 'Parsing %d lines (%d requests).' % (len(lines), options.requests)
+  print '%8s %12s %12s %14s %14s' % (
+      'columns', 'old us/line', 'new us/line', 'old us/column',
+      'new us/column')
+  base = None
+  for count in (0, 1, 5, 10, 20):
+    columns = custom_columns(count)
+    compiled = logparser.compile_custom_columns(columns)
+    old = time_parse(parse_line_uncompiled, lines, columns, options.repeat)
+    new = time_parse(logparser.parse_line, lines, compiled, options.repeat)
+    old_us = old * 1e6 / len(lines)
+    new_us = new * 1e6 / len(lines)
+    if base is None:
+      base = min(old_us, new_us)
+    if count:
+      print '%8d %12.2f %12.2f %14.3f %14.3f' % (
+          count, old_us, new_us, (old_us - base) / count,
+          (new_us - base) / count)
+    else:
+      print '%8d %12.2f %12.2f %14s %14s' % (count, old_us, new_us, '-', '-')
+
+
+if __name__ == '__main__':
+  main()
@@ -68,6 +68,8 @@ Contents of the Database Table:
    remotehost (%h)
    user (%u)
    request_time_str (%t)
+   request_time_ms (%t, as milliseconds since the epoch)
+   request_hour (%t, as hours since the epoch)
    request_line (%r)
    status (%s)
    bytes (%b)
@@ -118,7 +120,11 @@ Custom Columns:
   sqlite> select sum(cpu_ms)/cast(sum(widgets) as float)
      ...> from requests where widgets > '';
 
-  You can specify multiple --custom_column flags.
+  You can specify multiple --custom_column flags. Each regexp is compiled once,
+  and applog lines that lack its longest required literal (" widgets" above)
+  are skipped without running it, so lines a column cannot match cost almost
+  nothing. custom_column_benchmark.py measures the cost per
+  column.
 
 
 Handling Duplicate Items:
@@ -138,14 +144,104 @@ Handling Duplicate Items:
   appcfg.py request_logs --include_all <appdirectory> request.txt
   # Run the logparser to insert them into requests.db.
   logparser.py --discard_duplicates --db requests.db requests.txt applogs.txt
+
+
+Ingest Performance:
+
+  Input files are split into chunks of whole request records which are parsed
+  by a pool of --processes worker processes (one per CPU by default; on
+  Python 2.5, which has no multiprocessing, they are parsed serially). Parsed
+  rows are written with executemany, --batch_size rows per transaction. A
+  throughput report (lines/s, rows/s) is printed for every file.
+
+
+Rollups and Indexes:
+
+  Queries like the ones above scan the whole requests table. With --rollups,
+  two summary tables are kept up to date in the same transactions as the rows
+  they summarize:
+
+   rollup_minute, one row per minute (request_time_ms of its first ms)
+   rollup_url, one row per request_line and status
+
+  Requests whose time could not be parsed are counted under minute -1, and
+  requests without a status under status 0, so both tables add up to all
+  the requests.
+
+  Both have the columns requests, loading_requests, sum_ms, sum_cpu_ms,
+  sum_cpm_usd, cpm_usd_count, p50_ms and p95_ms. The percentiles come from
+  ms_histogram, a latency histogram with buckets 10% wide, so they are
+  approximate. When --rollups is first used on an existing database, the
+  tables are filled from the rows already in it.
+
+  sqlite> -- what are the most common 404s?
+  sqlite> select request_line, requests from rollup_url
+     ...> where status == 404 order by requests desc;
+  sqlite> -- How many loading requests were seen?
+  sqlite> select sum(loading_requests) from rollup_minute;
+  sqlite> -- What was the average cpm across all pages?
+  sqlite> select sum(sum_cpm_usd)/sum(cpm_usd_count) from rollup_minute;
+
+  With --indexes, the requests table is indexed on status, request_line and
+  request_time_ms once parsing is done, for the queries rollups cannot answer.
+  Time windows can then be queried with an index range scan:
+
+  sqlite> -- How many requests were there from 19:00 to 20:00 UTC?
+  sqlite> select count(*) from requests where request_time_ms
+     ...> between strftime('%s', '2010-10-18 19:00') * 1000
+     ...> and strftime('%s', '2010-10-18 20:00') * 1000 - 1;
+
+
+Incremental Ingest:
+
+  With --incremental, the byte offset reached in every input file is recorded
+  in the ingest_checkpoints table, in the same transaction as the rows read up
+  to it. The next --incremental run over the same file only parses what was
+  appended since, so a log that grows daily can be refreshed in seconds:
+
+  appcfg.py request_logs --append --include_all <appdirectory> requests.txt
+  logparser.py --incremental --db requests.db requests.txt
+
+  The last request record in a file may still be getting applog lines, so it
+  is left for the next run, and the offset stays at its start. Appended data
+  is expected to start with a request log line. If the start of the file or
+  the bytes before the recorded offset have changed, the file is parsed from
+  the start again (combine with --discard_duplicates to skip rows already in
+  the database).
 """
 # pylint: disable-msg=C6409
 
+import collections
+import datetime
+import hashlib
 import logging
+import math
 import optparse
+import os
 import re
+import sre_constants
+import sre_parse
 import sys
 import sqlite3
+import time
+
+try:
+  import multiprocessing
+except ImportError:
+  # Python 2.5 has no multiprocessing, so everything is parsed in this
+  # process.
+  multiprocessing = None
+
+
+# Rows inserted per transaction.
+DEFAULT_BATCH_SIZE = 10000
+# Request records handed to a worker process at a time.
+DEFAULT_CHUNK_SIZE = 2000
+# Worker processes to parse with: one per CPU, where there can be several.
+if multiprocessing:
+  DEFAULT_PROCESSES = multiprocessing.cpu_count()
+else:
+  DEFAULT_PROCESSES = 1
 
 
 class Error(Exception):
@@ -187,6 +283,8 @@ def create_database(db_filename, discard_duplicates, custom_columns):
       '  user text,\n'
       '  request_time_str text,\n'
       '  request_time DATETIME,\n'  # Not yet really implemented.
+      '  request_time_ms int,\n'
+      '  request_hour int,\n'
       '  request_line text,\n'
       '  status int,\n'
       '  bytes int,\n'
@@ -225,10 +323,88 @@ def create_database(db_filename, discard_duplicates, custom_columns):
       logging.exception('Exception creating table:')
       raise
     # TODO: Check that the schema matches.
+    # Databases created before these columns were added lack them.
+    existing_columns = set(row[1] for row in connection.execute(
+        'pragma table_info(requests)'))
+    for column in ('request_time_ms', 'request_hour'):
+      if column not in existing_columns:
+        connection.execute('alter table requests add column %s int' % column)
+  connection.execute(CHECKPOINT_TABLE_SIGNATURE)
 
   return connection
 
 
+CHECKPOINT_TABLE_SIGNATURE = (
+    'create table if not exists ingest_checkpoints (\n'
+    '  filename text primary key,\n'
+    '  offset int,\n'
+    '  head_hash text,\n'
+    '  tail_hash text\n'
+    ')')
+
+
+class Checkpoint(object):
+  """How far into an input file has been ingested, for --incremental.
+
+  The byte offset just past the last ingested line is stored in the
+  ingest_checkpoints table, together with hashes of the bytes at the start of
+  the file and just before the offset. A file whose hashes no longer match
+  has been replaced or rewritten, and is re-read from the start.
+  """
+
+  # Bytes hashed at the start of the file and just before the offset.
+  HASH_BYTES = 4096
+
+  def __init__(self, filename):
+    self.filename = os.path.abspath(filename)
+    self.offset = 0
+    # A separate handle, so hashing does not disturb the one being parsed.
+    self._file = open(self.filename, 'rb')
+
+  def close(self):
+    self._file.close()
+
+  def _hash_range(self, start, end):
+    self._file.seek(start)
+    return hashlib.sha1(self._file.read(end - start)).hexdigest()
+
+  def _hashes(self, offset):
+    return (self._hash_range(0, min(offset, self.HASH_BYTES)),
+            self._hash_range(max(0, offset - self.HASH_BYTES), offset))
+
+  def load(self, connection):
+    """Find where ingest of the file left off.
+
+    Args:
+      connection: Sqlite3 connection with the checkpoint table created.
+
+    Returns:
+      The byte offset to resume parsing from; 0 for a new or changed file.
+    """
+    row = connection.execute(
+        'select offset, head_hash, tail_hash from ingest_checkpoints '
+        'where filename = ?', (self.filename,)).fetchone()
+    self.offset = 0
+    if row:
+      offset, head_hash, tail_hash = row
+      self._file.seek(0, 2)
+      if (offset <= self._file.tell() and
+          self._hashes(offset) == (head_hash, tail_hash)):
+        self.offset = offset
+      else:
+        logging.warning('%s changed since it was last parsed; '
+                        'parsing it from the start.', self.filename)
+    return self.offset
+
+  def save(self, connection):
+    """Record the current offset. Runs inside the caller's transaction."""
+    head_hash, tail_hash = self._hashes(self.offset)
+    connection.execute(
+        'insert or replace into ingest_checkpoints '
+        '(filename, offset, head_hash, tail_hash) values (?, ?, ?, ?)',
+        (self.filename, self.offset, head_hash, tail_hash))
+
+
 # An ugly regex to match the start of the request log line.
 #            %h   %l    %u       %t          \"%r\"            %>s
 #            %b       \"%{Referer}i\"    \"%{User-agent}i\""
@@ -237,6 +413,154 @@ LINE_RE = ('([^ ]+) - ([^ ]+) \[([^]]+)\] (-|"(\\\\.|[^"])*") ([^ ]+) '
 LINE_RE_COMPILED = re.compile(LINE_RE)
 
 
+def _literal_runs(subpattern, runs):
+  """Collect the runs of literal characters every match must contain.
+
+  Only literals at the top level of the pattern or inside plain groups are
+  considered; anything under a repeat or an alternation may be skipped.
+
+  Args:
+    subpattern: A parsed pattern from sre_parse.
+    runs: List to append the literal strings to.
+  """
+  run = []
+  for op, av in subpattern:
+    if op == sre_constants.LITERAL and av < 128:
+      run.append(chr(av))
+      continue
+    runs.append(''.join(run))
+    run = []
+    if op == sre_constants.SUBPATTERN:
+      # (group, pattern) before Python 3.6, (group, add, del, pattern) after.
+      if len(av) == 4 and av[1] & sre_constants.SRE_FLAG_IGNORECASE:
+        continue
+      _literal_runs(av[-1], runs)
+  runs.append(''.join(run))
+
+
+def required_literal(regexp):
+  """Return the longest literal substring every match of regexp contains.
+
+  Args:
+    regexp: A regular expression string.
+
+  Returns:
+    The literal, or '' if there is none that can safely be required.
+  """
+  try:
+    parsed = sre_parse.parse(regexp)
+  except (sre_constants.error, OverflowError, RuntimeError):
+    return ''
+  if parsed.pattern.flags & sre_constants.SRE_FLAG_IGNORECASE:
+    return ''
+  runs = []
+  _literal_runs(parsed, runs)
+  return max(runs, key=len)
+
+
+class CustomColumns(object):
+  """Custom column regexps, compiled once.
+
+  Every regexp is compiled up front along with the longest literal substring
+  all of its matches contain. An applog line that lacks the literal is
+  rejected with a plain substring test instead of a regexp scan, so the cost
+  of a custom column on lines it cannot match is close to zero.
+  """
+
+  def __init__(self, custom_columns):
+    self.custom_columns = dict(custom_columns)
+    self._columns = [
+        (column, required_literal(regexp), re.compile(regexp))
+        for column, regexp in sorted(self.custom_columns.iteritems())]
+
+  def __getstate__(self):
+    # Compiled patterns are rebuilt rather than pickled to worker processes.
+    return self.custom_columns
+
+  def __setstate__(self, custom_columns):
+    self.__init__(custom_columns)
+
+  def search(self, applog, results):
+    """Search an applog line, storing the first group of every match.
+
+    Args:
+      applog: The applog line.
+      results: Dictionary to store column: value in.
+    """
+    for column, literal, regexp in self._columns:
+      if literal and literal not in applog:
+        continue
+      match = regexp.search(applog)
+      if match:
+        # TODO: Consider allowing named groups.
+        results[column] = match.group(1)
+
+
+_custom_columns_cache = {}
+
+
+def compile_custom_columns(custom_columns):
+  """Return custom_columns as a CustomColumns, compiling it at most once.
+
+  Args:
+    custom_columns: Dict of colname: regexp, or a CustomColumns.
+
+  Returns:
+    A CustomColumns.
+  """
+  if isinstance(custom_columns, CustomColumns):
+    return custom_columns
+  key = tuple(sorted(custom_columns.iteritems()))
+  compiled = _custom_columns_cache.get(key)
+  if compiled is None:
+    compiled = _custom_columns_cache[key] = CustomColumns(custom_columns)
+  return compiled
+
+
+MONTHS = {
+    'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+    'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12,
+}
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+# dd/Mon/yyyy: days since the epoch. One entry per day seen in the logs.
+_epoch_days_cache = {}
+
+
+def parse_request_time(time_str):
+  """Parse a %t timestamp into milliseconds since the epoch.
+
+  Written out by hand because time.strptime is much slower, and cannot
+  handle the zone offset anyway.
+
+  Args:
+    time_str: Timestamp such as '18/Oct/2010:12:34:56 -0700'.
+
+  Returns:
+    Milliseconds since the epoch, or None if time_str is malformed.
+  """
+  if (len(time_str) != 26 or time_str[11] != ':' or time_str[20] != ' '
+      or time_str[21] not in '+-'):
+    return None
+  try:
+    day = time_str[:11]
+    days = _epoch_days_cache.get(day)
+    if days is None:
+      days = datetime.date(int(time_str[7:11]), MONTHS[time_str[3:6]],
+                           int(time_str[:2])).toordinal() - EPOCH_ORDINAL
+      _epoch_days_cache[day] = days
+    seconds = (days * 86400 + int(time_str[12:14]) * 3600 +
+               int(time_str[15:17]) * 60 + int(time_str[18:20]))
+    offset = int(time_str[22:24]) * 3600 + int(time_str[24:26]) * 60
+  except (KeyError, ValueError):
+    return None
+  if time_str[21] == '-':
+    seconds += offset
+  else:
+    seconds -= offset
+  return seconds * 1000
+
+
 def parse_line(line, custom_columns):
   """Parse a line and return a dict of values.
 
@@ -244,7 +568,7 @@ def parse_line(line, custom_columns):
 
   Args:
     line: A line from the log file.
-    custom_columns: Dict of colname: regexp.
+    custom_columns: Dict of colname: regexp, or a CustomColumns.
 
   Returns:
     Dictionary of values. If this is a request log line, it contains the
@@ -263,11 +587,7 @@ def parse_line(line, custom_columns):
     if (len(applog) > 2 and applog[1] == ':'
         and applog[0] >= '0' and applog[0] <= '9'):
       results['applog_severity'] = applog[0]
-    for column, regexp in custom_columns.iteritems():
-      match = re.search(regexp, applog)
-      if match:
-        # TODO: Consider allowing named groups.
-        results[column] = match.group(1)
+    compile_custom_columns(custom_columns).search(applog, results)
     return results
 
   matches = LINE_RE_COMPILED.match(line)
@@ -277,6 +597,10 @@ def parse_line(line, custom_columns):
   results['remotehost'] = matches.group(1)
   results['user'] = matches.group(2)
   results['request_time_str'] = matches.group(3)
+  request_time_ms = parse_request_time(results['request_time_str'])
+  if request_time_ms is not None:
+    results['request_time_ms'] = request_time_ms
+    results['request_hour'] = request_time_ms // 3600000
   results['request_line'] = matches.group(4)
   # Submatch = matches.group(5)
   results['status'] = matches.group(6)
@@ -300,57 +624,66 @@ def parse_line(line, custom_columns):
   return results
 
 
-def insert_row(row_dict, insert_cursor, discard_duplicates):
-  """Insert a row into the database, including conversions if necessary.
+def iter_records(lines):
+  """Group log lines into request records.
+
+  A record is a request log line followed by the tab-indented applog lines
+  that belong to it. Applog lines seen before any request line form a record
+  of their own, as they always have.
 
   Args:
-    row_dict: Dictionary of data to insert.
-    insert_cursor: A cursor to the database to execute the insert on.
-    discard_duplicates: If duplicates should be discarded.
+    lines: Iterator returning log lines.
 
-  Returns:
-    Boolean, True if the row was successfully inserted into the db, else False.
+  Yields:
+    Lists of lines, one per request record.
   """
-  columns = []
-  values = []
-  # Calculating an insert statement may be vulnerable to sql injection. However,
-  # this is an offline tool. Perhaps sqlite3 can handle this using sqlite3.Row?
-  for column, value in row_dict.iteritems():
-    columns.append(column)
-    values.append(value)
+  record = []
+  for line in lines:
+    if record and not line.startswith('\t'):
+      yield record
+      record = []
+    record.append(line)
+  if record:
+    yield record
 
-  try:
-    statement = ('insert into requests (%s) values (%s)' %
-                 (','.join(columns), ','.join(['?'] * len(columns))))
-    insert_cursor.execute(statement, values)
-  except sqlite3.IntegrityError:
-    if not discard_duplicates:
-      # This should never happen anyway as we shouldn't have specified
-      # a primary key. But if someone re-uses the db, it might.
-      raise
-    return False
-  return True
 
+def iter_chunks(lines, chunk_size):
+  """Split log lines into chunks of whole request records.
 
-def parse_log_file(lines, connection, discard_duplicates, custom_columns):
-  """Parse every input line, insert it into the db as appropriate.
+  Args:
+    lines: Iterator returning log lines.
+    chunk_size: Number of request records per chunk.
+
+  Yields:
+    Lists of records (each a list of lines).
+  """
+  chunk = []
+  for record in iter_records(lines):
+    chunk.append(record)
+    if len(chunk) >= chunk_size:
+      yield chunk
+      chunk = []
+  if chunk:
+    yield chunk
+
+
+def parse_record(record, custom_columns, discard_duplicates):
+  """Parse a single request record into a row dict.
 
   Args:
-    lines: Iterator returning log lines to parse.
-    connection: Sqlite3 connection with the requests table created.
-    discard_duplicates: If it should attempt to discard duplicate log lines.
-    custom_columns: Dictionary, column name: regexp.
+    record: List of lines, as returned by iter_records.
+    custom_columns: Dict of colname: regexp.
+    discard_duplicates: If the request log line should be stored as the key.
 
   Returns:
-    request_count, insert_count: The number of requests seen, and the number
-      inserted. (Will differ if discard_duplicates is true.)
+    Dictionary of column values for the requests table.
+
+  Raises:
+    LineParsingFailure: cannot parse one of the lines.
   """
   result_dict = {}
-  insert_cursor = connection.cursor()
-  request_count = 0
-  insert_count = 0
   applog_severity = ''
-  for line in lines:
+  for line in record:
     parsed_line = parse_line(line, custom_columns)
     if 'applog' in parsed_line:
       # TODO: Discard the first severity 0 applog line, which seems to be
@@ -364,30 +697,409 @@ def parse_log_file(lines, connection, discard_duplicates, custom_columns):
       # Everything else is a custom column. Last one wins.
       result_dict.update(parsed_line)
       continue
-    # At this point we've reached a new line. Write the old one.
-    if request_count % 100 == 0:
-      print '.',
-      sys.stdout.flush()
-    request_count += 1
-    if result_dict:
-      inserted = insert_row(result_dict, insert_cursor, discard_duplicates)
-      if inserted:
-        insert_count += 1
     result_dict = parsed_line
     applog_severity = ''
     if discard_duplicates:
       result_dict['request_log'] = line
+  return result_dict
+
 
-  # Add the last row.
-  if result_dict:
-    inserted = insert_row(result_dict, insert_cursor, discard_duplicates)
-    if inserted:
-      insert_count += 1
+def parse_chunk(args):
+  """Parse a chunk of request records. Runs in the worker processes.
+
+  Args:
+    args: Tuple of (chunk, custom_columns, discard_duplicates); a single
+      argument so it can be handed to a multiprocessing pool.
+
+  Returns:
+    rows, line_count, byte_count, request_count: The parsed row dicts, the
+      number of lines and bytes they came from and the number of request log
+      lines among them.
+  """
+  chunk, custom_columns, discard_duplicates = args
+  custom_columns = compile_custom_columns(custom_columns)
+  rows = []
+  line_count = 0
+  byte_count = 0
+  request_count = 0
+  for record in chunk:
+    line_count += len(record)
+    byte_count += sum(len(line) for line in record)
+    if not record[0].startswith('\t'):
+      request_count += 1
+    rows.append(parse_record(record, custom_columns, discard_duplicates))
+  return rows, line_count, byte_count, request_count
+
+
+def iter_parsed_chunks(lines, custom_columns, discard_duplicates, processes,
+                       chunk_size):
+  """Parse log lines, optionally across a pool of processes.
+
+  Chunks are handed out in order and at most a few per process are in flight
+  at once, so memory stays bounded however large the input is.
+
+  Args:
+    lines: Iterator returning log lines to parse.
+    custom_columns: Dictionary, column name: regexp.
+    discard_duplicates: If it should attempt to discard duplicate log lines.
+    processes: Number of worker processes; 1, or no multiprocessing module,
+      parses in this process.
+    chunk_size: Number of request records per chunk.
+
+  Yields:
+    The results of parse_chunk, in input order.
+  """
+  tasks = ((chunk, custom_columns, discard_duplicates)
+           for chunk in iter_chunks(lines, chunk_size))
+  if processes <= 1 or multiprocessing is None:
+    for task in tasks:
+      yield parse_chunk(task)
+    return
+
+  pool = multiprocessing.Pool(processes)
+  try:
+    pending = collections.deque()
+    for task in tasks:
+      pending.append(pool.apply_async(parse_chunk, (task,)))
+      if len(pending) >= processes * 2:
+        yield pending.popleft().get()
+    while pending:
+      yield pending.popleft().get()
+    pool.close()
+  finally:
+    pool.terminate()
+    pool.join()
+
+
+# Latency histograms use buckets growing by this factor, so percentiles read
+# from them are within 10% of the exact value.
+LATENCY_BUCKET_GROWTH = 1.1
+_LOG_LATENCY_BUCKET_GROWTH = math.log(LATENCY_BUCKET_GROWTH)
+
+ROLLUP_COLUMNS_SIGNATURE = (
+    '  requests int,\n'
+    '  loading_requests int,\n'
+    '  sum_ms int,\n'
+    '  sum_cpu_ms int,\n'
+    '  sum_cpm_usd float,\n'
+    '  cpm_usd_count int,\n'
+    '  ms_histogram text,\n'
+    '  p50_ms int,\n'
+    '  p95_ms int,\n')
+
+# Rollup keys of requests whose time or status is unknown, since a NULL
+# primary key would never be replaced.
+UNKNOWN_MINUTE = -1
+UNKNOWN_STATUS = 0
+
+# Table name: key columns.
+ROLLUP_TABLES = {
+    'rollup_minute': ('minute',),
+    'rollup_url': ('request_line', 'status'),
+}
+
+ROLLUP_TABLE_SIGNATURES = (
+    'create table rollup_minute (\n'
+    '  minute int,\n'
+    + ROLLUP_COLUMNS_SIGNATURE +
+    '  primary key (minute)\n'
+    ')',
+    'create table rollup_url (\n'
+    '  request_line text,\n'
+    '  status int,\n'
+    + ROLLUP_COLUMNS_SIGNATURE +
+    '  primary key (request_line, status)\n'
+    ')',
+)
+
+INDEX_SIGNATURES = (
+    'create index if not exists requests_status on requests (status)',
+    'create index if not exists requests_request_line '
+    'on requests (request_line)',
+    'create index if not exists requests_request_time_ms '
+    'on requests (request_time_ms)',
+)
+
+
+def create_rollup_tables(connection):
+  """Create the rollup tables, filling them from any rows already present.
+
+  Rollup tables with an older schema, such as rollup_minute keyed by minute
+  text, are dropped and rebuilt from the requests table.
+
+  Args:
+    connection: Sqlite3 connection with the requests table created.
+  """
+  existing = dict(connection.execute(
+      "select name, sql from sqlite_master where type = 'table'"))
+  # sqlite keeps the statement, but with 'create table' in upper case.
+  current = [existing.get(signature.split()[2], '').split(None, 2)[-1:]
+             for signature in ROLLUP_TABLE_SIGNATURES]
+  if current == [signature.split(None, 2)[-1:]
+                 for signature in ROLLUP_TABLE_SIGNATURES]:
+    return
+  connection.execute('begin')
+  try:
+    for table in ROLLUP_TABLES:
+      connection.execute('drop table if exists %s' % table)
+    for signature in ROLLUP_TABLE_SIGNATURES:
+      connection.execute(signature)
+    update_rollups(connection, 0)
+  except:
+    connection.execute('rollback')
+    raise
+  connection.execute('commit')
+
+
+def create_indexes(connection):
+  """Create indexes on the requests columns dashboards filter on."""
+  for signature in INDEX_SIGNATURES:
+    connection.execute(signature)
+
+
+def latency_bucket(ms):
+  """Return the histogram bucket a latency in ms falls in."""
+  return int(math.log(ms + 1) / _LOG_LATENCY_BUCKET_GROWTH)
+
+
+def latency_percentile(histogram, fraction):
+  """Return the approximate latency below which fraction of requests fall.
+
+  Args:
+    histogram: Dict of bucket: count, as built from latency_bucket.
+    fraction: The percentile wanted, between 0 and 1.
+
+  Returns:
+    The upper bound in ms of the bucket containing the percentile, or None if
+    the histogram is empty.
+  """
+  total = sum(histogram.itervalues())
+  if not total:
+    return None
+  remaining = fraction * total
+  for bucket in sorted(histogram):
+    remaining -= histogram[bucket]
+    if remaining <= 0:
+      break
+  return int(math.ceil(LATENCY_BUCKET_GROWTH ** (bucket + 1) - 1))
+
+
+def format_histogram(histogram):
+  """Serialize a histogram to 'bucket:count,...' for storage."""
+  return ','.join('%d:%d' % item for item in sorted(histogram.iteritems()))
+
+
+def parse_histogram(text):
+  """Parse a histogram stored by format_histogram."""
+  histogram = {}
+  if text:
+    for item in text.split(','):
+      bucket, count = item.split(':')
+      histogram[int(bucket)] = int(count)
+  return histogram
+
+
+def update_rollups(connection, after_rowid):
+  """Fold newly inserted requests rows into the rollup tables.
+
+  Rows are read back from the requests table rather than taken from the
+  batch, so rows discarded as duplicates are not counted. Runs inside the
+  caller's transaction.
+
+  Args:
+    connection: Sqlite3 connection with the rollup tables created.
+    after_rowid: Only rows with a greater rowid are rolled up.
+  """
+  summaries = dict((table, {}) for table in ROLLUP_TABLES)
+  for time_ms, request_line, status, ms, cpu_ms, cpm_usd, loading in (
+      connection.execute(
+          'select request_time_ms, request_line, status, ms, cpu_ms, '
+          'cpm_usd, loading_request from requests where rowid > ?',
+          (after_rowid,))):
+    if request_line is None:
+      # Applog lines seen before any request line.
+      continue
+    if time_ms is None:
+      time_ms = UNKNOWN_MINUTE
+    else:
+      time_ms -= time_ms % 60000
+    if status is None:
+      status = UNKNOWN_STATUS
+    keys = {
+        'rollup_minute': (time_ms,),
+        'rollup_url': (request_line, status),
+    }
+    for table, key in keys.iteritems():
+      summary = summaries[table].get(key)
+      if summary is None:
+        summary = summaries[table][key] = [0, 0, 0, 0, 0.0, 0, {}]
+      summary[0] += 1
+      if loading:
+        summary[1] += 1
+      if ms is not None:
+        summary[2] += ms
+        bucket = latency_bucket(ms)
+        summary[6][bucket] = summary[6].get(bucket, 0) + 1
+      if cpu_ms is not None:
+        summary[3] += cpu_ms
+      if cpm_usd is not None:
+        summary[4] += cpm_usd
+        summary[5] += 1
+
+  for table, key_columns in ROLLUP_TABLES.iteritems():
+    where = ' and '.join('%s = ?' % column for column in key_columns)
+    columns = key_columns + (
+        'requests', 'loading_requests', 'sum_ms', 'sum_cpu_ms', 'sum_cpm_usd',
+        'cpm_usd_count', 'ms_histogram', 'p50_ms', 'p95_ms')
+    insert = 'insert or replace into %s (%s) values (%s)' % (
+        table, ','.join(columns), ','.join(['?'] * len(columns)))
+    for key, summary in summaries[table].iteritems():
+      existing = connection.execute(
+          'select requests, loading_requests, sum_ms, sum_cpu_ms, '
+          'sum_cpm_usd, cpm_usd_count, ms_histogram from %s where %s'
+          % (table, where), key).fetchone()
+      histogram = summary[6]
+      if existing:
+        for i in xrange(6):
+          summary[i] += existing[i]
+        for bucket, count in parse_histogram(existing[6]).iteritems():
+          histogram[bucket] = histogram.get(bucket, 0) + count
+      connection.execute(insert, key + tuple(summary[:6]) + (
+          format_histogram(histogram), latency_percentile(histogram, 0.5),
+          latency_percentile(histogram, 0.95)))
+
+
+def insert_rows(rows, connection, discard_duplicates, checkpoint=None,
+                rollups=False):
+  """Insert a batch of rows into the database in a single transaction.
+
+  The whole batch is written with one executemany over the union of the
+  columns seen in it; columns a row lacks are inserted as NULL, which is what
+  leaving them out of the insert would have done.
+
+  Args:
+    rows: List of row dicts to insert.
+    connection: Sqlite3 connection with the requests table created.
+    discard_duplicates: If duplicates should be discarded.
+    checkpoint: Optional Checkpoint to save in the same transaction.
+    rollups: If the rollup tables should be updated in the same transaction.
+
+  Returns:
+    The number of rows actually inserted.
+  """
+  columns = set()
+  for row in rows:
+    columns.update(row)
+  columns = sorted(columns)
+
+  # Calculating an insert statement may be vulnerable to sql injection. However,
+  # this is an offline tool.
+  if discard_duplicates:
+    verb = 'insert or ignore'
+  else:
+    # If someone re-uses a db that has a primary key, this raises
+    # sqlite3.IntegrityError, as it always has.
+    verb = 'insert'
+  statement = '%s into requests (%s) values (%s)' % (
+      verb, ','.join(columns), ','.join(['?'] * len(columns)))
+  changes_before = connection.total_changes
+  connection.execute('begin')
+  try:
+    if rollups:
+      (max_rowid,) = connection.execute(
+          'select max(rowid) from requests').fetchone()
+    connection.executemany(
+        statement, ([row.get(column) for column in columns] for row in rows))
+    insert_count = connection.total_changes - changes_before
+    if rollups:
+      update_rollups(connection, max_rowid or 0)
+    if checkpoint:
+      checkpoint.save(connection)
+  except:
+    connection.execute('rollback')
+    raise
+  connection.execute('commit')
+  return insert_count
+
+
+def parse_log_file(lines, connection, discard_duplicates, custom_columns,
+                   processes=1, batch_size=DEFAULT_BATCH_SIZE,
+                   chunk_size=DEFAULT_CHUNK_SIZE, checkpoint=None,
+                   rollups=False):
+  """Parse every input line, insert it into the db as appropriate.
+
+  Args:
+    lines: Iterator returning log lines to parse.
+    connection: Sqlite3 connection with the requests table created.
+    discard_duplicates: If it should attempt to discard duplicate log lines.
+    custom_columns: Dictionary, column name: regexp.
+    processes: Number of processes to parse with.
+    batch_size: Number of rows to insert per transaction.
+    chunk_size: Number of request records handed to a process at a time.
+    checkpoint: Optional Checkpoint of the file the lines are read from,
+      advanced and saved along with every batch.
+    rollups: If the rollup tables should be updated along with every batch.
+
+  Returns:
+    request_count, insert_count, line_count: The number of requests seen, the
+      number inserted (will differ if discard_duplicates is true), and the
+      number of lines read.
+  """
+  request_count = 0
+  insert_count = 0
+  line_count = 0
+  batch = []
+  for rows, chunk_lines, chunk_bytes, chunk_requests in iter_parsed_chunks(
+      lines, custom_columns, discard_duplicates, processes, chunk_size):
+    if (request_count + chunk_requests) / 1000 > request_count / 1000:
+      print '.',
+      sys.stdout.flush()
+    line_count += chunk_lines
+    request_count += chunk_requests
+    batch.extend(rows)
+    if checkpoint:
+      checkpoint.offset += chunk_bytes
+    if len(batch) >= batch_size:
+      insert_count += insert_rows(batch, connection, discard_duplicates,
+                                  checkpoint, rollups)
+      batch = []
+
+  if batch:
+    insert_count += insert_rows(batch, connection, discard_duplicates,
+                                checkpoint, rollups)
 
-  connection.commit()
-  insert_cursor.close()
   print ''
-  return request_count, insert_count
+  return request_count, insert_count, line_count
+
+
+def iter_complete_lines(lines):
+  """Yield only the lines of request records that are known to be complete.
+
+  A trailing line without a newline may still be being written, and so may
+  the applog lines of the last request record. Both are left for the next
+  --incremental run rather than ingested half-way; a record is only yielded
+  once the request log line after it has been read.
+  """
+  record = []
+  for line in lines:
+    if not line.endswith('\n'):
+      logging.info('Leaving incomplete last line for the next run.')
+      break
+    if record and not line.startswith('\t'):
+      for record_line in record:
+        yield record_line
+      record = []
+    record.append(line)
+  if record:
+    logging.info('Leaving the last request record for the next run.')
+
+
+def report_throughput(line_count, row_count, elapsed):
+  """Print how fast lines were parsed and rows were inserted."""
+  elapsed = max(elapsed, 1e-6)
+  print '%d lines, %d rows in %.1fs (%.0f lines/s, %.0f rows/s)' % (
+      line_count, row_count, elapsed, line_count / elapsed,
+      row_count / elapsed)
 
 
 def parse_arguments():
@@ -401,6 +1113,23 @@ def parse_arguments():
   parser.add_option('--custom_column', dest='custom_columns', action='append',
                     help='Custom column (can be multiple); format is '
                     'name:regexp. Run across app logs.')
+  parser.add_option('--processes', dest='processes', type='int',
+                    default=DEFAULT_PROCESSES,
+                    help='Number of processes to parse with '
+                    '(default: %default).')
+  parser.add_option('--batch_size', dest='batch_size', type='int',
+                    default=DEFAULT_BATCH_SIZE,
+                    help='Rows to insert per transaction (default: %default).')
+  parser.add_option('--rollups', dest='rollups', action='store_true',
+                    default=False,
+                    help='Maintain the rollup_minute and rollup_url tables.')
+  parser.add_option('--indexes', dest='indexes', action='store_true',
+                    default=False,
+                    help='Index the requests table after parsing.')
+  parser.add_option('--incremental', dest='incremental',
+                    action='store_true', default=False,
+                    help='Only parse what was appended to each input file '
+                    'since the last --incremental run.')
 
   options, args = parser.parse_args()
 
@@ -411,6 +1140,10 @@ def parse_arguments():
   for flag in required_flags:
     if not getattr(options, flag):
       errors.append('--%s is required' % flag)
+  if options.processes < 1:
+    errors.append('--processes must be at least 1')
+  if options.batch_size < 1:
+    errors.append('--batch_size must be at least 1')
   if errors:
     parser.print_help()
     print '\nErrors: '
@@ -433,20 +1166,50 @@ def main():
 
   connection = create_database(options.db, options.discard_duplicates,
                                custom_columns)
+  if options.rollups:
+    create_rollup_tables(connection)
 
   request_count_total = 0
   insert_count_total = 0
+  line_count_total = 0
+  start_total = time.time()
   for filename in input_filenames:
     print 'Parsing %s' % filename
-    f = open(filename, 'r')
-    request_count, insert_count = parse_log_file(f, connection,
-                                                 options.discard_duplicates,
-                                                 custom_columns)
+    start = time.time()
+    checkpoint = None
+    if options.incremental:
+      checkpoint = Checkpoint(filename)
+      f = open(filename, 'rb')
+      offset = checkpoint.load(connection)
+      if offset:
+        print 'Resuming at byte %d' % offset
+      f.seek(offset)
+      lines = iter_complete_lines(f)
+    else:
+      f = open(filename, 'r')
+      lines = f
+    try:
+      request_count, insert_count, line_count = parse_log_file(
+          lines, connection, options.discard_duplicates, custom_columns,
+          processes=options.processes, batch_size=options.batch_size,
+          checkpoint=checkpoint, rollups=options.rollups)
+    finally:
+      f.close()
+      if checkpoint:
+        checkpoint.close()
+    report_throughput(line_count, insert_count, time.time() - start)
     request_count_total += request_count
     insert_count_total += insert_count
+    line_count_total += line_count
+
+  if options.indexes:
+    print 'Indexing'
+    create_indexes(connection)
 
   print 'Done! Parsed %d requests. %d duplicate rows.' % (
       request_count_total, request_count_total - insert_count_total)
+  report_throughput(line_count_total, insert_count_total,
+                    time.time() - start_total)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+#
+# Copyright 2010 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests for the logparser rollup tables and incremental ingest."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import logparser
+
+
+class RollupTest(unittest.TestCase):
+
+  def setUp(self):
+    self.connection = logparser.create_database(':memory:', False, {})
+    logparser.create_rollup_tables(self.connection)
+
+  def insert_batches(self, rows, batch_size):
+    for start in xrange(0, len(rows), batch_size):
+      logparser.insert_rows(rows[start:start + batch_size], self.connection,
+                            False, rollups=True)
+
+  def make_rows(self, count):
+    rows = []
+    for i in xrange(count):
+      row = {'request_line': 'GET /%d HTTP/1.1' % (i % 7),
+             'status': 200, 'ms': i % 300,
+             'request_time_ms': 1262304000000 + i * 1000}
+      if i % 5 == 0:
+        # The time could not be parsed.
+        row['request_time_ms'] = None
+      if i % 11 == 0:
+        row['status'] = None
+      rows.append(row)
+    return rows
+
+  def assertRollupsAddUp(self, count):
+    for table in logparser.ROLLUP_TABLES:
+      (requests,) = self.connection.execute(
+          'select sum(requests) from %s' % table).fetchone()
+      self.assertEqual(count, requests, table)
+
+  def test_rollups_add_up_to_row_count(self):
+    self.insert_batches(self.make_rows(3000), 100)
+    self.assertRollupsAddUp(3000)
+    (unknown,) = self.connection.execute(
+        'select count(*) from rollup_minute where minute = ?',
+        (logparser.UNKNOWN_MINUTE,)).fetchone()
+    self.assertEqual(1, unknown)
+    (null_keys,) = self.connection.execute(
+        'select count(*) from rollup_minute where minute is null').fetchone()
+    self.assertEqual(0, null_keys)
+    (null_keys,) = self.connection.execute(
+        'select count(*) from rollup_url where status is null').fetchone()
+    self.assertEqual(0, null_keys)
+
+  def test_old_rollup_schema_is_rebuilt(self):
+    self.insert_batches(self.make_rows(300), 100)
+    # The schema before rollup_minute was keyed by request_time_ms.
+    self.connection.execute('drop table rollup_minute')
+    self.connection.execute(
+        'create table rollup_minute (\n'
+        '  minute text,\n'
+        + logparser.ROLLUP_COLUMNS_SIGNATURE +
+        '  primary key (minute)\n'
+        ')')
+    self.connection.execute(
+        "insert into rollup_minute (minute, requests) "
+        "values ('01/Jan/2010:00:00', 5)")
+    logparser.create_rollup_tables(self.connection)
+    self.assertRollupsAddUp(300)
+    (text_keys,) = self.connection.execute(
+        "select count(*) from rollup_minute where typeof(minute) = 'text'"
+        ).fetchone()
+    self.assertEqual(0, text_keys)
+
+  def test_current_rollup_schema_is_kept(self):
+    self.insert_batches(self.make_rows(300), 100)
+    self.connection.execute('update rollup_url set requests = requests + 1')
+    logparser.create_rollup_tables(self.connection)
+    (requests,) = self.connection.execute(
+        'select sum(requests) from rollup_url').fetchone()
+    self.assertNotEqual(300, requests)
+
+
+class IncrementalTest(unittest.TestCase):
+
+  def setUp(self):
+    self.connection = logparser.create_database(':memory:', False, {})
+    self.directory = tempfile.mkdtemp()
+    self.filename = os.path.join(self.directory, 'requests.txt')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def make_record(self, i):
+    return ['1.2.3.4 - - [18/Oct/2010:20:00:%02d -0700] "GET /%d HTTP/1.1" '
+            '200 10 - "agent" example.com\n' % (i, i),
+            '\t1:1287457200.0 first %d\n' % i,
+            '\t2:1287457200.0 second %d\n' % i]
+
+  def append(self, lines):
+    log_file = open(self.filename, 'ab')
+    log_file.writelines(lines)
+    log_file.close()
+
+  def ingest(self):
+    """Run what main() runs for a file with --incremental."""
+    checkpoint = logparser.Checkpoint(self.filename)
+    log_file = open(self.filename, 'rb')
+    try:
+      log_file.seek(checkpoint.load(self.connection))
+      logparser.parse_log_file(logparser.iter_complete_lines(log_file),
+                               self.connection, False, {},
+                               checkpoint=checkpoint)
+    finally:
+      log_file.close()
+      checkpoint.close()
+
+  def applogs(self):
+    return [applog for (applog,) in self.connection.execute(
+        'select applog from requests order by request_time_ms')]
+
+  def test_record_split_mid_way_is_ingested_whole(self):
+    lines = []
+    for i in xrange(4):
+      lines.extend(self.make_record(i))
+    # The log ends after the first applog line of the third record.
+    self.append(lines[:7])
+    self.ingest()
+    self.assertEqual(2, len(self.applogs()))
+    self.append(lines[7:])
+    self.ingest()
+    # The fourth record is held back in turn.
+    applogs = self.applogs()
+    self.assertEqual(3, len(applogs))
+    self.assertEqual('\n1:1287457200.0 first 2\n2:1287457200.0 second 2',
+                     applogs[2])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python2.7
+#
+# Copyright 2008 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Contention simulation for generalcounter's adaptive sharding.
+
+Threads hammer a hot counter while a cold one is incremented now and then,
+all against the local datastore stub. Every window, the increment rate,
+transaction collisions and shard counts of both counters are printed; at the
+end the counter values are checked against the increments made.
+
+Run it twice to compare, once with --no_auto_sharding:
+
+  contention_benchmark.py /path/to/google_appengine
+  contention_benchmark.py --no_auto_sharding /path/to/google_appengine
+"""
+
+import optparse
+import sys
+import threading
+import time
+
+USAGE = """%prog [options] SDK_PATH
+
+SDK_PATH    Path to the SDK installation"""
+
+HOT = 'hot-counter'
+COLD = 'cold-counter'
+
+
+def run(options):
+  """Run the simulation and print its results."""
+  from google.appengine.api import memcache
+  from google.appengine.datastore import datastore_stub_util
+  from google.appengine.ext import db
+  from google.appengine.ext import testbed
+  import generalcounter
+
+  bed = testbed.Testbed()
+  bed.activate()
+  bed.init_datastore_v3_stub(
+      consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+          probability=1))
+  bed.init_memcache_stub()
+
+  generalcounter.AUTO_SHARDING = options.auto_sharding
+  generalcounter.ADAPT_WINDOW_SECS = options.window
+  generalcounter.FOLD_GRACE_SECS = options.window
+  for name in (HOT, COLD):
+    generalcounter.GeneralCounterShardConfig(
+        key_name=name, name=name, num_shards=options.shards).put()
+
+  # The tallies below are updated from every thread.
+  lock = threading.Lock()
+  def tally(counts, key):
+    lock.acquire()
+    try:
+      counts[key] += 1
+    finally:
+      lock.release()
+
+  # Count every collision, including the retried ones.
+  collisions = {'total': 0}
+  run_in_transaction_custom_retries = db.run_in_transaction_custom_retries
+  def counting_run_in_transaction(retries, function):
+    try:
+      return run_in_transaction_custom_retries(retries, function)
+    except db.TransactionFailedError:
+      tally(collisions, 'total')
+      raise
+  db.run_in_transaction_custom_retries = counting_run_in_transaction
+
+  increments = {HOT: 0, COLD: 0}
+  failures = {'total': 0}
+  stop = threading.Event()
+
+  def worker(name, pause):
+    while not stop.isSet():
+      try:
+        generalcounter.increment(name)
+        tally(increments, name)
+      except db.TransactionFailedError:
+        tally(failures, 'total')
+      if pause:
+        stop.wait(pause)
+
+  threads = [threading.Thread(target=worker, args=(HOT, 0))
+             for _ in range(options.threads)]
+  threads.append(threading.Thread(target=worker, args=(COLD, 1.0)))
+  for thread in threads:
+    thread.start()
+
+  print '%6s %10s %11s %10s %11s' % (
+      'secs', 'hot inc/s', 'collision %', 'hot shards', 'cold shards')
+  start = time.time()
+  last_increments = last_collisions = 0
+  try:
+    while time.time() - start < options.duration:
+      time.sleep(options.window)
+      hot, total_collisions = increments[HOT], collisions['total']
+      attempts = hot - last_increments + total_collisions - last_collisions
+      configs = generalcounter.GeneralCounterShardConfig.get_by_key_name(
+          [HOT, COLD])
+      print '%6.0f %10.1f %11.1f %10d %11d' % (
+          time.time() - start, (hot - last_increments) / options.window,
+          100.0 * (total_collisions - last_collisions) / max(attempts, 1),
+          configs[0].num_shards, configs[1].num_shards)
+      last_increments, last_collisions = hot, total_collisions
+  finally:
+    stop.set()
+    for thread in threads:
+      thread.join()
+
+  memcache.flush_all()
+  for name in (HOT, COLD):
+    count = generalcounter.get_count(name)
+    print '%s: %d increments, count %d%s' % (
+        name, increments[name], count,
+        '' if count == increments[name] else ' MISMATCH')
+  print '%d increments gave up after %d attempts.' % (
+      failures['total'], generalcounter.TRANSACTION_ATTEMPTS)
+  bed.deactivate()
+
+
+def main():
+  parser = optparse.OptionParser(USAGE)
+  parser.add_option('--threads', dest='threads', type='int', default=8,
+                    help='Threads incrementing the hot counter.')
+  parser.add_option('--shards', dest='shards', type='int', default=4,
+                    help='Shards both counters start with.')
+  parser.add_option('--duration', dest='duration', type='float', default=60,
+                    help='Seconds to run for.')
+  parser.add_option('--window', dest='window', type='float', default=5,
+                    help='Seconds per contention window and report line.')
+  parser.add_option('--no_auto_sharding', dest='auto_sharding',
+                    action='store_false', default=True,
+                    help='Keep the starting shard counts.')
+  options, args = parser.parse_args()
+  if len(args) != 1:
+    print 'Error: Exactly 1 argument required.'
+    parser.print_help()
+    sys.exit(1)
+
+  sys.path.insert(0, args[0])
+  import dev_appserver
+  dev_appserver.fix_sys_path()
+  run(options)
+
+
+if __name__ == '__main__':
+  main()
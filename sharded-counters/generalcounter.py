@@ -15,18 +15,77 @@
 
 from google.appengine.api import memcache 
 from google.appengine.ext import db
+import calendar
+import logging
 import random
+import threading
+import time
+
+# Buffered increments are flushed by the first call into this module once
+# they are this old...
+FLUSH_INTERVAL_SECS = 10
+# ...or as soon as the sizes of the pending deltas add up to this many,
+# whichever comes first. Flushes only happen when this module is called, by a
+# buffered_increment() or by flush_if_due() at the end of a request, so an
+# instance that stops getting requests keeps its pending increments until it
+# gets another one, and loses them if it is shut down first. Use increment()
+# for counts that must not be lost.
+FLUSH_THRESHOLD = 100
+
+# Most entities fetched in one datastore get.
+MAX_BATCH_GET = 1000
+
+# Deltas from buffered_increment not yet written, keyed by counter name.
+_pending = {}
+_pending_total = 0
+_pending_lock = threading.Lock()
+_last_flush = time.time()
+
+# Set to False to only ever change shard counts with increase_shards().
+AUTO_SHARDING = True
+# Contention is measured over windows of this length, per instance.
+ADAPT_WINDOW_SECS = 60
+# A counter grows (doubles its shards) when more than this fraction of its
+# transaction attempts in a window collide...
+GROW_COLLISION_RATE = 0.1
+MAX_SHARDS = 200
+# ...and shrinks (halves them) when none collide and each shard sees fewer
+# than this many writes per second, from this instance and from all of them.
+# The writes from all instances are counted on the shards and sampled in
+# memcache, in this namespace, at most once per window.
+COLD_WRITES_PER_SHARD_PER_SEC = 0.05
+WRITES_SAMPLE_NAMESPACE = 'generalcounter-writes'
+MIN_SHARDS = 2
+# Shards dropped by shrinking are folded into the remaining ones only after
+# this long, so increments still using the old shard count are not lost.
+FOLD_GRACE_SECS = 60
+# Transaction attempts per increment before giving up, as run_in_transaction.
+TRANSACTION_ATTEMPTS = 4
+
+# Counter name: [increments, collisions, window start] for this instance.
+_contention = {}
 
 class GeneralCounterShardConfig(db.Model):
   """Tracks the number of shards for each named counter."""
   name = db.StringProperty(required=True)
   num_shards = db.IntegerProperty(required=True, default=20)
+  # After shrinking, the shards from num_shards up to fold_shards still hold
+  # counts until they are folded into the remaining ones.
+  fold_shards = db.IntegerProperty(default=0)
+  updated = db.DateTimeProperty(auto_now=True)
+
+  def read_shards(self):
+    """The number of shards that may hold part of the count."""
+    return max(self.num_shards, self.fold_shards or 0)
 
 
 class GeneralCounterShard(db.Model):
   """Shards for each named counter"""
   name = db.StringProperty(required=True)
   count = db.IntegerProperty(required=True, default=0)
+  # Transactions that have written to this shard, for the counter's write
+  # rate across all instances.
+  writes = db.IntegerProperty(default=0)
   
             
 def get_count(name):
@@ -35,13 +94,43 @@ def get_count(name):
   Parameters:
     name - The name of the counter  
   """
-  total = memcache.get(name)
-  if total is None:
-    total = 0
-    for counter in GeneralCounterShard.all().filter('name = ', name):
-      total += counter.count
-    memcache.add(name, total, 60)
-  return total
+  return get_counts([name])[name]
+
+
+def get_counts(names):
+  """Retrieve the values for several sharded counters at once.
+
+  Uses one memcache get_multi. Counters missing from memcache have their
+  shard configs and then all of their shards fetched by key name, one batch
+  get each, and the totals are added back to memcache in one call.
+
+  Parameters:
+    names - The names of the counters
+
+  Returns:
+    A dict mapping each name to its value.
+  """
+  names = list(set(names))
+  totals = memcache.get_multi(names)
+  missing = [name for name in names if name not in totals]
+  if missing:
+    shard_names = set()
+    for config in GeneralCounterShardConfig.get_by_key_name(missing):
+      if config is not None:
+        shard_names.update(config.name + str(index)
+                           for index in range(config.read_shards()))
+    shard_names = list(shard_names)
+    fetched = dict((name, 0) for name in missing)
+    for start in range(0, len(shard_names), MAX_BATCH_GET):
+      for counter in GeneralCounterShard.get_by_key_name(
+          shard_names[start:start + MAX_BATCH_GET]):
+        # Shard key names of "FOO" and "FOO1" can overlap, so check the name.
+        if counter is not None and counter.name in fetched:
+          fetched[counter.name] += counter.count
+    # add, not set, so concurrent increments of the cached value are kept.
+    memcache.add_multi(fetched, 60)
+    totals.update(fetched)
+  return dict((name, totals[name] + _pending.get(name, 0)) for name in names)
 
   
 def increment(name):
@@ -51,31 +140,279 @@ def increment(name):
     name - The name of the counter  
   """
   config = GeneralCounterShardConfig.get_or_insert(name, name=name)
+  _add_to_shard(config, name, 1)
+  # does nothing if the key does not exist
+  memcache.incr(name)
+
+
+def _add_to_shard(config, name, delta):
+  """Add delta to a random shard of a counter in a single transaction.
+
+  Retries on collision like run_in_transaction, but counts the collisions so
+  the shard count can adapt to them.
+  """
   def txn():
     index = random.randint(0, config.num_shards - 1)
     shard_name = name + str(index)
     counter = GeneralCounterShard.get_by_key_name(shard_name)
     if counter is None:
       counter = GeneralCounterShard(key_name=shard_name, name=name)
-    counter.count += 1
+    counter.count += delta
+    counter.writes = (counter.writes or 0) + 1
     counter.put()
+  stats = _contention.setdefault(name, [0, 0, time.time()])
+  for attempt in range(TRANSACTION_ATTEMPTS):
+    try:
+      db.run_in_transaction_custom_retries(0, txn)
+      break
+    except db.TransactionFailedError:
+      stats[1] += 1
+      if attempt == TRANSACTION_ATTEMPTS - 1:
+        raise
+  stats[0] += 1
+  if AUTO_SHARDING:
+    try:
+      _adapt_shards(config, name, stats)
+    except Exception:
+      # The delta is written; resizing is retried after the next window.
+      logging.exception('Failed to adapt the shards of counter %s.', name)
+
+
+def _adapt_shards(config, name, stats):
+  """Grow or shrink a counter's shards once its contention window is over.
+
+  Parameters:
+    config - The counter's GeneralCounterShardConfig
+    name - The name of the counter
+    stats - The counter's [increments, collisions, window start]
+  """
+  now = time.time()
+  elapsed = now - stats[2]
+  if elapsed < ADAPT_WINDOW_SECS:
+    return
+  increments, collisions = stats[0], stats[1]
+  _contention[name] = [0, 0, now]
+
+  if collisions > (increments + collisions) * GROW_COLLISION_RATE:
+    if config.num_shards < MAX_SHARDS:
+      _resize_shards(name, min(config.num_shards * 2, MAX_SHARDS))
+  elif (not collisions and config.num_shards > MIN_SHARDS and
+        increments < config.num_shards * COLD_WRITES_PER_SHARD_PER_SEC *
+        elapsed and _is_cold(config, name, now)):
+    _resize_shards(name, max(config.num_shards // 2, MIN_SHARDS))
+  elif (config.read_shards() > config.num_shards and
+        calendar.timegm(config.updated.utctimetuple()) <
+        now - FOLD_GRACE_SECS):
+    _fold_shards(name)
+
+
+def _is_cold(config, name, now):
+  """Whether a counter gets too few writes, from all instances, to shrink.
+
+  Each instance only sees its own increments, so a counter that is hot
+  overall but spread over many instances looks cold on every one of them.
+  The writes recorded on the counter's shards are summed instead, and the
+  total is sampled in memcache for every instance to measure the rate from.
+
+  Parameters:
+    config - The counter's GeneralCounterShardConfig
+    name - The name of the counter
+    now - The current time, in seconds since the epoch
+
+  Returns:
+    True if the rate since the last sample is cold. False if it isn't, or if
+    there is no sample at least a window old to measure it from yet.
+  """
+  sample = memcache.get(name, namespace=WRITES_SAMPLE_NAMESPACE)
+  if sample is not None and now - sample[1] < ADAPT_WINDOW_SECS:
+    return False
+  shard_names = [name + str(index) for index in range(config.read_shards())]
+  writes = 0
+  for start in range(0, len(shard_names), MAX_BATCH_GET):
+    for shard in GeneralCounterShard.get_by_key_name(
+        shard_names[start:start + MAX_BATCH_GET]):
+      # Shard key names of "FOO" and "FOO1" can overlap, so check the name.
+      if shard is not None and shard.name == name:
+        writes += shard.writes or 0
+  memcache.set(name, (writes, now), namespace=WRITES_SAMPLE_NAMESPACE)
+  if sample is None:
+    return False
+  sampled_writes, sampled_at = sample
+  return (writes - sampled_writes <
+          config.num_shards * COLD_WRITES_PER_SHARD_PER_SEC *
+          (now - sampled_at))
+
+
+def _resize_shards(name, num):
+  """Change the number of shards new increments of a counter go to.
+
+  Growing takes effect at once. When shrinking, the dropped shards are kept
+  for reads until _fold_shards() folds them into the remaining ones.
+
+  Parameters:
+    name - The name of the counter
+    num - How many shards to use
+  """
+  def txn():
+    config = GeneralCounterShardConfig.get_by_key_name(name)
+    if config is None or config.num_shards == num:
+      return
+    if num < config.num_shards:
+      config.fold_shards = config.read_shards()
+    elif num >= config.read_shards():
+      config.fold_shards = 0
+    logging.info('Resizing counter %s from %d to %d shards.',
+                 name, config.num_shards, num)
+    config.num_shards = num
+    config.put()
   db.run_in_transaction(txn)
-  # does nothing if the key does not exist
-  memcache.incr(name)
 
-  
+
+def _fold_shards(name):
+  """Fold a counter's shards beyond num_shards into the remaining ones.
+
+  Every dropped shard is moved in its own cross-group transaction with the
+  config, so no count is lost or stored twice. get_counts() reads the shards
+  outside a transaction, though, so a read that overlaps a move can miss or
+  double count the shard being moved, until memcache expires it.
+
+  Parameters:
+    name - The name of the counter
+  """
+  def txn():
+    config = GeneralCounterShardConfig.get_by_key_name(name)
+    if config.read_shards() <= config.num_shards:
+      if config.fold_shards:
+        config.fold_shards = 0
+        config.put()
+      return False
+    index = config.read_shards() - 1
+    shard = GeneralCounterShard.get_by_key_name(name + str(index))
+    # Shard key names of "FOO" and "FOO1" can overlap, so check the name.
+    if shard is not None and shard.name == name:
+      target_name = name + str(index % config.num_shards)
+      target = GeneralCounterShard.get_by_key_name(target_name)
+      if target is None:
+        target = GeneralCounterShard(key_name=target_name, name=name)
+      target.count += shard.count
+      target.writes = (target.writes or 0) + (shard.writes or 0)
+      target.put()
+      shard.delete()
+    config.fold_shards = index
+    config.put()
+    return True
+  xg = db.create_transaction_options(xg=True)
+  while db.run_in_transaction_options(xg, txn):
+    pass
+
+
+def buffered_increment(name, delta=1):
+  """Increment a sharded counter in instance memory, to be written later.
+
+  The delta is added to the pending deltas of this instance, which are
+  written by flush() in one transaction per counter. That happens here once
+  the pending deltas add up to FLUSH_THRESHOLD in size or FLUSH_INTERVAL_SECS
+  have passed, and whenever flush_if_due() or flush() is called. get_count()
+  on this instance includes the pending delta. Pending deltas are lost if the
+  instance is shut down before they are flushed; see FLUSH_THRESHOLD.
+
+  Parameters:
+    name - The name of the counter
+    delta - How much to add
+  """
+  global _pending_total
+  _pending_lock.acquire()
+  try:
+    _pending[name] = _pending.get(name, 0) + delta
+    _pending_total += abs(delta)
+  finally:
+    _pending_lock.release()
+  flush_if_due()
+
+
+def flush_if_due():
+  """Flush pending buffered increments if the size or time limit is reached.
+
+  Cheap when nothing is due, so it can be called at the end of every request.
+  """
+  if _pending and (_pending_total >= FLUSH_THRESHOLD or
+                   time.time() - _last_flush >= FLUSH_INTERVAL_SECS):
+    flush()
+
+
+def flush():
+  """Write all pending buffered increments to the datastore and memcache.
+
+  Each counter's pending delta is added to one of its shards in a single
+  transaction. Deltas that fail to write, including the ones not yet tried
+  when the flush is interrupted (e.g. by DeadlineExceededError), are kept
+  pending for the next flush.
+  """
+  global _pending, _pending_total, _last_flush
+  _pending_lock.acquire()
+  try:
+    pending = _pending
+    _pending = {}
+    _pending_total = 0
+    _last_flush = time.time()
+  finally:
+    _pending_lock.release()
+
+  written = set()
+  try:
+    for name, delta in pending.iteritems():
+      if not delta:
+        written.add(name)
+        continue
+      try:
+        config = GeneralCounterShardConfig.get_or_insert(name, name=name)
+        _add_to_shard(config, name, delta)
+      except Exception:
+        logging.exception('Failed to flush counter %s; keeping it pending.',
+                          name)
+        continue
+      written.add(name)
+      try:
+        # does nothing if the key does not exist
+        if delta > 0:
+          memcache.incr(name, delta)
+        else:
+          memcache.decr(name, -delta)
+      except Exception:
+        logging.exception('Failed to update the cached count of %s.', name)
+  finally:
+    # Runs even for errors not derived from Exception, such as
+    # DeadlineExceededError, so no delta that wasn't written is dropped.
+    unwritten = [(name, delta) for name, delta in pending.iteritems()
+                 if name not in written]
+    if unwritten:
+      _pending_lock.acquire()
+      try:
+        for name, delta in unwritten:
+          _pending[name] = _pending.get(name, 0) + delta
+          _pending_total += abs(delta)
+      finally:
+        _pending_lock.release()
+
+
 def increase_shards(name, num):  
   """Increase the number of shards for a given sharded counter.
-  Will never decrease the number of shards.
+  Does nothing if the counter already has at least num shards. This is not a
+  lasting minimum: with AUTO_SHARDING, a counter that goes idle is shrunk
+  again, down to MIN_SHARDS. Set AUTO_SHARDING to False to keep the shard
+  counts set here.
   
   Parameters:
     name - The name of the counter
     num - How many shards to use
     
   """
-  config = GeneralCounterShardConfig.get_or_insert(name, name=name)
+  GeneralCounterShardConfig.get_or_insert(name, name=name)
   def txn():
+    config = GeneralCounterShardConfig.get_by_key_name(name)
     if config.num_shards < num:
+      if num >= config.read_shards():
+        config.fold_shards = 0
       config.num_shards = num
       config.put()    
   db.run_in_transaction(txn)
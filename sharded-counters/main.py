@@ -47,6 +47,8 @@ class CounterHandler(webapp.RequestHandler):
     counter = self.request.get('counter')
     if counter == 'simple':
       simplecounter.increment()
+    elif counter == 'buffered':
+      generalcounter.buffered_increment('FOO')
     else:
       generalcounter.increment('FOO')
     self.redirect("/")
@@ -58,6 +60,8 @@ def main():
     ('/', CounterHandler),
   ], debug=True)
   wsgiref.handlers.CGIHandler().run(application)
+  # Write out generalcounter.buffered_increment() deltas that are due.
+  generalcounter.flush_if_due()
 
 
 if __name__ == '__main__':
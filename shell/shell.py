@@ -36,13 +36,19 @@ your app.yaml.
 TODO: unit tests!
 """
 
+import _ast
+import dis
+import hashlib
 import logging
 import new
 import os
 import pickle
 import sys
+import threading
+import time
 import traceback
 import types
+import uuid
 import wsgiref.handlers
 
 from google.appengine.api import users
@@ -57,6 +63,32 @@ _DEBUG = True
 # The entity kind for shell sessions. Feel free to rename to suit your app.
 _SESSION_KIND = '_Shell_Session'
 
+# Collapse a session's unpicklable statements after this many are added.
+_SNAPSHOT_INTERVAL = 20
+
+# The number of sessions whose live globals are kept in each instance.
+_SESSION_CACHE_SIZE = 20
+
+# Marks a missing value, since None is a value like any other.
+_MISSING = object()
+
+# The opcodes that look up or delete a global by name.
+_GLOBAL_OPS = frozenset([dis.opmap[name] for name in
+                         ('LOAD_NAME', 'LOAD_GLOBAL', 'DELETE_NAME',
+                          'DELETE_GLOBAL')])
+
+# Types whose values can't change in place, so they only change when rebound.
+IMMUTABLE_TYPES = (
+  types.NoneType,
+  bool,
+  int,
+  long,
+  float,
+  complex,
+  str,
+  unicode,
+  )
+
 # Types that can't be pickled.
 UNPICKLABLE_TYPES = (
   types.ModuleType,
@@ -76,21 +108,183 @@ INITIAL_UNPICKLABLES = [
   ]
 
 
+def code_names(code):
+  """Returns the global names looked up or deleted by a code object.
+
+  Includes the names used by the code nested in it, such as function and
+  class bodies, so these are all the globals the code could use, other than
+  through globals() or eval().
+
+  Args:
+    code: a code object
+  """
+  names = set()
+  bytecode = code.co_code
+  extended_arg = 0
+  i = 0
+  while i < len(bytecode):
+    op = ord(bytecode[i])
+    if op < dis.HAVE_ARGUMENT:
+      i += 1
+      continue
+    arg = ord(bytecode[i + 1]) + ord(bytecode[i + 2]) * 256 + extended_arg
+    extended_arg = 0
+    i += 3
+    if op == dis.EXTENDED_ARG:
+      extended_arg = arg * 65536L
+    elif op in _GLOBAL_OPS:
+      names.add(code.co_names[arg])
+  for const in code.co_consts:
+    if isinstance(const, types.CodeType):
+      names.update(code_names(const))
+  return names
+
+
+def defines_only(statement):
+  """Returns True if a statement only imports and defines names.
+
+  That is, it only has imports, function definitions, class definitions whose
+  bodies only define names, and assignments of constants. Running such a
+  statement again has no effect but binding its names, so it's redundant once
+  they're all rebound. (A module only runs the first time it's imported.)
+  Decorators, and default argument values and base classes that aren't plain
+  names, could run any code, so statements with them don't count.
+
+  Args:
+    statement: string, the source of the statement
+  """
+  try:
+    tree = compile(statement, '<string>', 'exec', _ast.PyCF_ONLY_AST)
+  except SyntaxError:
+    return False
+  return _defines_only(tree.body)
+
+
+def _is_name(node):
+  """Returns True if an expression node is a name or a dotted name."""
+  while isinstance(node, _ast.Attribute):
+    node = node.value
+  return isinstance(node, _ast.Name)
+
+
+def _is_constant(node):
+  """Returns True if an expression node is a literal number or string."""
+  return isinstance(node, (_ast.Num, _ast.Str))
+
+
+def _defines_only(nodes):
+  """Returns True if a list of statement nodes only imports and defines."""
+  for node in nodes:
+    if isinstance(node, (_ast.Import, _ast.ImportFrom, _ast.Pass)):
+      continue
+    elif isinstance(node, _ast.Expr) and _is_constant(node.value):
+      continue
+    elif isinstance(node, _ast.Assign):
+      if ([target for target in node.targets
+           if not isinstance(target, _ast.Name)] or
+          not (_is_constant(node.value) or _is_name(node.value))):
+        return False
+    elif isinstance(node, _ast.FunctionDef):
+      # decorators were renamed decorator_list in Python 2.6
+      if (getattr(node, 'decorator_list', None) or
+          getattr(node, 'decorators', None) or
+          [default for default in node.args.defaults
+           if not (_is_constant(default) or _is_name(default))]):
+        return False
+    elif isinstance(node, _ast.ClassDef):
+      if (getattr(node, 'decorator_list', None) or
+          [base for base in node.bases if not _is_name(base)] or
+          not _defines_only(node.body)):
+        return False
+    else:
+      return False
+  return True
+
+
+def fingerprint(blob):
+  """Returns a short digest of a pickled value, to tell if it has changed.
+
+  Args:
+    blob: string, the pickled value
+  """
+  return hashlib.md5(blob).digest()
+
+
+class NameIndex(object):
+  """Constant time lookups, additions and removals for a list of names.
+
+  The list is changed in place, so it can be a list property of an entity.
+  Removing a name moves the last name in the list into its place, so the
+  order of the list isn't kept.
+  """
+
+  def __init__(self, names):
+    """Constructor.
+
+    Args:
+      names: list of strings, without duplicates.
+    """
+    self.names = names
+    self._positions = dict((name, i) for i, name in enumerate(names))
+
+  def __contains__(self, name):
+    return name in self._positions
+
+  def add(self, name):
+    """Adds a name to the end of the list, if it's not in it already.
+
+    Returns:
+      True if the name was added.
+    """
+    if name in self._positions:
+      return False
+    self._positions[name] = len(self.names)
+    self.names.append(db.Text(name))
+    return True
+
+  def remove(self, name):
+    """Removes a name from the list, if it's in it.
+
+    Returns:
+      True if the name was removed.
+    """
+    position = self._positions.pop(name, None)
+    if position is None:
+      return False
+    last = self.names.pop()
+    if position < len(self.names):
+      self.names[position] = last
+      self._positions[last] = position
+    return True
+
+
+class SessionGlobal(db.Model):
+  """A picklable global of a shell session.
+
+  Its parent is the session, and its key name is the name of the global.
+  """
+  value = db.BlobProperty()
+
+
 class Session(db.Model):
   """A shell session. Stores the session's globals.
 
   Each session globals is stored in one of two places:
 
-  If the global is picklable, it's stored in the parallel globals and
-  global_names list properties. (They're parallel lists to work around the
-  unfortunate fact that the datastore can't store dictionaries natively.)
+  If the global is picklable, it's stored in its own SessionGlobal entity,
+  a child of the session, and its name is in the global_names list property.
+  That way a statement only has to load the globals it uses, and only the
+  globals it changes are written back. (Older versions stored them in the
+  parallel globals and global_names list properties. migrate_globals() moves
+  them.)
 
   If the global is not picklable (e.g. modules, classes, and functions), or if
   it was created by the same statement that created an unpicklable global,
   it's not stored directly. Instead, the statement is stored in the
   unpicklables list property. On each request, before executing the current
   statement, the unpicklable statements are evaluated to recreate the
-  unpicklable globals.
+  unpicklable globals. Every _SNAPSHOT_INTERVAL statements, the ones that no
+  longer matter are dropped; see snapshot_unpicklables().
 
   The unpicklable_names property stores all of the names of globals that were
   added by unpicklable statements. When we pickle and store the globals after
@@ -98,11 +292,88 @@ class Session(db.Model):
 
   Using Text instead of string is an optimization. We don't query on any of
   these properties, so they don't need to be indexed.
+
+  Sessions can have thousands of globals, so the two lists of names are
+  accessed through NameIndex objects instead of being searched.
   """
   global_names = db.ListProperty(db.Text)
   globals = db.ListProperty(db.Blob)
   unpicklable_names = db.ListProperty(db.Text)
   unpicklables = db.ListProperty(db.Text)
+  statements_since_snapshot = db.IntegerProperty(default=0)
+  stamp = db.StringProperty(default='')
+
+  def __init__(self, *args, **kwds):
+    super(Session, self).__init__(*args, **kwds)
+    self._changed = False
+    self._global_puts = {}
+    self._global_deletes = set()
+    self._indexes = {}
+
+  def _index(self, prop):
+    """Returns the NameIndex of a list of names property.
+
+    Args:
+      prop: string, global_names or unpicklable_names
+    """
+    names = getattr(self, prop)
+    index = self._indexes.get(prop)
+    if index is None or index.names is not names:
+      index = self._indexes[prop] = NameIndex(names)
+    return index
+
+  def global_key(self, name):
+    """Returns the key of the SessionGlobal entity for a global.
+
+    Args:
+      name: string, the name of the global
+    """
+    return db.Key.from_path(SessionGlobal.kind(), name, parent=self.key())
+
+  def has_global(self, name):
+    """Returns True if a picklable global with this name is stored.
+
+    Args:
+      name: string, the name of the global
+    """
+    return name in self._index('global_names')
+
+  def get_global_blobs(self, names):
+    """Fetches the pickled values of stored globals, in a single batch.
+
+    Args:
+      names: iterable of strings, the names of the globals. Names of globals
+        that aren't stored are ignored.
+
+    Returns:
+      A dictionary of the pickled value of each global, by name.
+    """
+    names = [name for name in names if self.has_global(name)]
+    blobs = {}
+    fetch = []
+    for name in names:
+      if name in self._global_puts:
+        blobs[name] = self._global_puts[name].value
+      else:
+        fetch.append(name)
+    if fetch:
+      entities = db.get([self.global_key(name) for name in fetch])
+      for name, entity in zip(fetch, entities):
+        if entity is not None:
+          blobs[name] = entity.value
+    return blobs
+
+  def migrate_globals(self):
+    """Moves globals stored by older versions into SessionGlobal entities.
+
+    The entities are written by the next save().
+    """
+    if self.globals:
+      for name, blob in zip(self.global_names, self.globals):
+        self._global_puts[name] = SessionGlobal(parent=self, key_name=name,
+                                                value=blob)
+      self.globals = []
+      self._changed = True
 
   def set_global(self, name, value):
     """Adds a global, or updates it if it already exists.
@@ -115,12 +386,11 @@ class Session(db.Model):
     """
     blob = db.Blob(pickle.dumps(value))
 
-    if name in self.global_names:
-      index = self.global_names.index(name)
-      self.globals[index] = blob
-    else:
-      self.global_names.append(db.Text(name))
-      self.globals.append(blob)
+    if self._index('global_names').add(name):
+      self._changed = True
+    self._global_puts[name] = SessionGlobal(parent=self, key_name=name,
+                                            value=blob)
+    self._global_deletes.discard(name)
 
     self.remove_unpicklable_name(name)
 
@@ -130,16 +400,10 @@ class Session(db.Model):
     Args:
       name: string, the name of the global to remove
     """
-    if name in self.global_names:
-      index = self.global_names.index(name)
-      del self.global_names[index]
-      del self.globals[index]
-
-  def globals_dict(self):
-    """Returns a dictionary view of the globals.
-    """
-    return dict((name, pickle.loads(val))
-                for name, val in zip(self.global_names, self.globals))
+    if self._index('global_names').remove(name):
+      self._global_puts.pop(name, None)
+      self._global_deletes.add(name)
+      self._changed = True
 
   def add_unpicklable(self, statement, names):
     """Adds a statement and list of names to the unpicklables.
@@ -151,11 +415,12 @@ class Session(db.Model):
       names: list of strings; the names of the globals created by the statement.
     """
     self.unpicklables.append(db.Text(statement))
+    self.statements_since_snapshot += 1
+    self._changed = True
 
     for name in names:
       self.remove_global(name)
-      if name not in self.unpicklable_names:
-        self.unpicklable_names.append(db.Text(name))
+      self._index('unpicklable_names').add(name)
 
   def remove_unpicklable_name(self, name):
     """Removes a name from the list of unpicklable names, if it exists.
@@ -163,8 +428,242 @@ class Session(db.Model):
     Args:
       name: string, the name of the unpicklable global to remove
     """
-    if name in self.unpicklable_names:
-      self.unpicklable_names.remove(name)
+    if self._index('unpicklable_names').remove(name):
+      self._changed = True
+
+  def snapshot_unpicklables(self, codes, namespace):
+    """Evaluates the unpicklables, then drops the ones that aren't needed.
+
+    A statement is needed if it does anything but import and define names
+    (see defines_only()), if a name that isn't stored as a picklable global
+    still has the value it gave it, or if a needed statement after it uses a
+    name it set. So, for example, a function that was redefined many times is
+    left with a single statement, but a statement that sets up a module it
+    imports is always kept.
+
+    Args:
+      codes: list of code objects, the compiled unpicklables.
+      namespace: the dictionary to evaluate them in.
+    """
+    bound = []
+    for code in codes:
+      before = dict(namespace)
+      exec code in namespace
+      bound.append(dict((name, val) for name, val in namespace.items()
+                        if before.get(name, _MISSING) is not val))
+
+    needed = [not defines_only(statement) for statement in self.unpicklables]
+    for i, names in enumerate(bound):
+      for name, val in names.items():
+        if namespace.get(name) is val and not self.has_global(name):
+          needed[i] = True
+
+    # going backwards, so the statements a needed one depends on are marked
+    # before they're reached
+    for i in xrange(len(codes) - 1, -1, -1):
+      if not needed[i]:
+        continue
+      for name in code_names(codes[i]):
+        for j in xrange(i - 1, -1, -1):
+          if name in bound[j]:
+            needed[j] = True
+            break
+
+    logging.info('Snapshot keeps %d of %d unpicklable statements.',
+                 needed.count(True), len(codes))
+    self.unpicklables = [statement for statement, keep
+                         in zip(self.unpicklables, needed) if keep]
+    self.statements_since_snapshot = 0
+    self._changed = True
+
+  def save(self):
+    """Writes the session and the globals that changed, if any did.
+
+    Whenever anything is written, the session gets a new random stamp, so
+    instances can tell whether the globals they cached are current. Unlike a
+    counter, two requests that save the same session at the same time can't
+    end up with the same stamp and each think their own module is current.
+
+    Returns:
+      A dictionary of the pickled value of each global written, by name.
+    """
+    written = dict((name, entity.value)
+                   for name, entity in self._global_puts.items())
+    if self._changed or written or self._global_deletes:
+      self.stamp = uuid.uuid4().hex
+      db.put(self._global_puts.values() + [self])
+    if self._global_deletes:
+      db.delete([self.global_key(name) for name in self._global_deletes])
+    self._changed = False
+    self._global_puts = {}
+    self._global_deletes = set()
+    return written
+
+
+class LazyGlobals(object):
+  """A mapping that loads a session's stored globals on first access.
+
+  Statements are executed with the statement module's dictionary as their
+  globals and this as their locals. Names looked up at the top level of a
+  statement go through __getitem__, which unpickles stored globals as they
+  are needed. Assignments and deletions go straight to the module.
+
+  Functions look their globals up in the module's dictionary directly, so
+  the globals used by the code that will run are loaded up front with load().
+
+  Attributes:
+    loaded: dictionary of (fingerprint, value) tuples of the globals loaded
+      so far, by name. See changed_in_place().
+  """
+
+  def __init__(self, session, namespace, out, loaded=None):
+    """Constructor.
+
+    Args:
+      session: the Session the globals are stored in.
+      namespace: the statement module's dictionary.
+      out: file-like object to report globals that can't be unpickled to.
+      loaded: the globals already in namespace, like the loaded attribute.
+    """
+    self.session = session
+    self.namespace = namespace
+    self.out = out
+    if loaded is None:
+      loaded = {}
+    self.loaded = loaded
+
+  def load(self, blobs):
+    """Unpickles globals into the namespace.
+
+    Globals that can't be unpickled are dropped from the session.
+
+    Args:
+      blobs: dictionary of pickled values, by name.
+    """
+    for name, blob in blobs.items():
+      try:
+        val = pickle.loads(blob)
+      except:
+        msg = 'Dropping %s since it could not be unpickled.\n' % name
+        self.out.write(msg)
+        logging.warning(msg + traceback.format_exc())
+        self.session.remove_global(name)
+        continue
+      self.namespace[name] = val
+      self.loaded[name] = (fingerprint(blob), val)
+
+  def changed_in_place(self, name):
+    """Returns True if a loaded global's value has changed since it was loaded.
+
+    Only changes made in place are detected; the global has to still be bound
+    to the same object. Values of immutable types can't change that way, and
+    the rest are pickled again and compared by fingerprint, rather than with
+    __eq__, which can be arbitrarily expensive.
+
+    Args:
+      name: string, the name of the global
+    """
+    old_fingerprint, val = self.loaded[name]
+    if self.namespace.get(name, _MISSING) is not val:
+      return False
+    if isinstance(val, IMMUTABLE_TYPES):
+      return False
+    return fingerprint(pickle.dumps(val)) != old_fingerprint
+
+  def __getitem__(self, name):
+    if name not in self.namespace and self.session.has_global(name):
+      self.load(self.session.get_global_blobs([name]))
+    return self.namespace[name]
+
+  def __setitem__(self, name, value):
+    self.namespace[name] = value
+
+  def __delitem__(self, name):
+    self[name]
+    del self.namespace[name]
+
+  def __contains__(self, name):
+    return name in self.namespace or self.session.has_global(name)
+
+  def get(self, name, default=None):
+    try:
+      return self[name]
+    except KeyError:
+      return default
+
+  def keys(self):
+    names = set(self.namespace)
+    names.update(self.session.global_names)
+    return list(names)
+
+
+class SessionCache(object):
+  """The live statement modules of recently used sessions in this instance.
+
+  A statement for a session whose module is cached runs in that module, so
+  its globals don't have to be unpickled and its unpicklables don't have to
+  be evaluated again. Each module is stored with the stamp of the session it
+  reflects, and is only used if the session still has that stamp.
+
+  A module is taken out of the cache while a statement runs in it, and only
+  put back if the statement succeeds and the session is saved, since a
+  statement that fails can leave it changed.
+  """
+
+  def __init__(self, size):
+    """Constructor.
+
+    Args:
+      size: the most sessions to keep.
+    """
+    self.size = size
+    self._entries = {}
+    self._lock = threading.Lock()
+
+  def take(self, key, stamp):
+    """Removes a session's module from the cache and returns it.
+
+    Args:
+      key: string, the session's key.
+      stamp: the session's current stamp.
+
+    Returns:
+      A (module, loaded globals, names used by the unpicklables) tuple, or
+      None if the session isn't cached or the cached module is out of date.
+    """
+    self._lock.acquire()
+    try:
+      entry = self._entries.pop(key, None)
+    finally:
+      self._lock.release()
+    if entry is None or entry[1] != stamp:
+      return None
+    return entry[2:]
+
+  def put(self, key, stamp, module, loaded, unpicklable_names_used):
+    """Caches a session's module, evicting the least recently used one.
+
+    Args:
+      key: string, the session's key.
+      stamp: the stamp of the session that the module reflects.
+      module: the statement module.
+      loaded: dictionary of the globals loaded from the datastore, as in
+        LazyGlobals.
+      unpicklable_names_used: set of the global names used by the session's
+        unpicklables. See code_names().
+    """
+    self._lock.acquire()
+    try:
+      if key not in self._entries and len(self._entries) >= self.size:
+        oldest = min(self._entries, key=lambda k: self._entries[k][0])
+        del self._entries[oldest]
+      self._entries[key] = (time.time(), stamp, module, loaded,
+                            unpicklable_names_used)
+    finally:
+      self._lock.release()
+
+
+_session_cache = SessionCache(_SESSION_CACHE_SIZE)
 
 
 class FrontPageHandler(webapp.RequestHandler):
@@ -223,48 +722,75 @@ class StatementHandler(webapp.RequestHandler):
       self.response.out.write(traceback.format_exc())
       return
 
-    # create a dedicated module to be used as this statement's __main__
-    statement_module = new.module('__main__')
+    # load the session from the datastore
+    session = Session.get(self.request.get('session'))
+    session.migrate_globals()
+    session_key = str(session.key())
+
+    # reuse the module this instance ran the session's last statement in, if
+    # the session hasn't changed since. otherwise, create a dedicated module
+    # to be used as this statement's __main__
+    cached = _session_cache.take(session_key, session.stamp)
+    if cached:
+      statement_module, loaded, unpicklable_names_used = cached
+    else:
+      statement_module = new.module('__main__')
+      loaded = None
 
     # use this request's __builtin__, since it changes on each request.
     # this is needed for import statements, among other things.
     import __builtin__
     statement_module.__builtins__ = __builtin__
 
-    # load the session from the datastore
-    session = Session.get(self.request.get('session'))
-
-    # swap in our custom module for __main__. then unpickle the session
-    # globals, run the statement, and re-pickle the session globals, all
-    # inside it.
+    # swap in our custom module for __main__. then load the session globals
+    # the statement uses, run the statement, and re-pickle the session globals
+    # that changed, all inside it.
     old_main = sys.modules.get('__main__')
     try:
       sys.modules['__main__'] = statement_module
       statement_module.__name__ = '__main__'
+      namespace = statement_module.__dict__
+      lazy_globals = LazyGlobals(session, namespace, self.response.out, loaded)
 
-      # re-evaluate the unpicklables
-      for code in session.unpicklables:
-        exec code in statement_module.__dict__
+      if cached:
+        # fetch the stored globals used by the statement that aren't loaded
+        lazy_globals.load(session.get_global_blobs(
+            name for name in code_names(compiled) if name not in namespace))
 
-      # re-initialize the globals
-      for name, val in session.globals_dict().items():
-        try:
-          statement_module.__dict__[name] = val
-        except:
-          msg = 'Dropping %s since it could not be unpickled.\n' % name
-          self.response.out.write(msg)
-          logging.warning(msg + traceback.format_exc())
-          session.remove_global(name)
+      else:
+        # fetch the stored globals used by the statement or the functions and
+        # classes defined by the unpicklables, in one batch
+        unpicklables = [compile(code, '<string>', 'exec')
+                        for code in session.unpicklables]
+        unpicklable_names_used = set()
+        for code in unpicklables:
+          unpicklable_names_used.update(code_names(code))
+        blobs = session.get_global_blobs(
+            unpicklable_names_used | code_names(compiled))
+
+        # re-evaluate the unpicklables
+        if session.statements_since_snapshot >= _SNAPSHOT_INTERVAL:
+          session.snapshot_unpicklables(unpicklables, namespace)
+        else:
+          for code in unpicklables:
+            exec code in namespace
+
+        # re-initialize the globals. values the unpicklables gave to names
+        # that have since been stored as picklable globals are out of date.
+        for name in namespace.keys():
+          if session.has_global(name):
+            del namespace[name]
+        lazy_globals.load(blobs)
 
       # run!
-      old_globals = dict(statement_module.__dict__)
+      old_globals = dict(namespace)
       try:
         old_stdout = sys.stdout
         old_stderr = sys.stderr
         try:
           sys.stdout = self.response.out
           sys.stderr = self.response.out
-          exec compiled in statement_module.__dict__
+          exec compiled in namespace, lazy_globals
         finally:
           sys.stdout = old_stdout
           sys.stderr = old_stderr
@@ -272,17 +798,28 @@ class StatementHandler(webapp.RequestHandler):
         self.response.out.write(traceback.format_exc())
         return
 
-      # extract the new globals that this statement added
+      # extract the new globals that this statement added or rebound, and
+      # the loaded ones that it changed in place
+      for name, (old_fingerprint, val) in lazy_globals.loaded.items():
+        old_globals.setdefault(name, val)
       new_globals = {}
-      for name, val in statement_module.__dict__.items():
-        if name not in old_globals or val != old_globals[name]:
+      for name, val in namespace.items():
+        if old_globals.get(name, _MISSING) is not val:
           new_globals[name] = val
+      # only code that looks a global up by name can change it in place: the
+      # statement, or the functions and classes defined by the unpicklables.
+      # the rest of the loaded globals aren't checked.
+      for name in code_names(compiled) | unpicklable_names_used:
+        if (name in lazy_globals.loaded and name not in new_globals and
+            lazy_globals.changed_in_place(name)):
+          new_globals[name] = namespace[name]
 
       if True in [isinstance(val, UNPICKLABLE_TYPES)
                   for val in new_globals.values()]:
         # this statement added an unpicklable global. store the statement and
         # the names of all of the globals it added in the unpicklables.
         session.add_unpicklable(statement, new_globals.keys())
+        unpicklable_names_used.update(code_names(compiled))
         logging.debug('Storing this statement as an unpicklable.')
 
       else:
@@ -292,10 +829,26 @@ class StatementHandler(webapp.RequestHandler):
           if not name.startswith('__'):
             session.set_global(name, val)
 
+      # forget the globals that this statement deleted
+      deleted = [name for name in old_globals if name not in namespace]
+      for name in deleted:
+        session.remove_global(name)
+
     finally:
       sys.modules['__main__'] = old_main
 
-    session.put()
+    written = session.save()
+
+    # cache the module, with the fingerprints of the globals in it that are
+    # now stored, to check for changes made in place by later statements
+    loaded = lazy_globals.loaded
+    for name in new_globals.keys() + deleted:
+      if name in written:
+        loaded[name] = (fingerprint(written[name]), namespace[name])
+      else:
+        loaded.pop(name, None)
+    _session_cache.put(session_key, session.stamp, statement_module, loaded,
+                       unpicklable_names_used)
 
 
 def main():
@@ -0,0 +1,70 @@
+#!/usr/bin/python
+#
+# Copyright 2007 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for collapsing the unpicklable statements of shell sessions.
+
+Needs the App Engine SDK on the path.
+"""
+
+import unittest
+
+from google.appengine.ext import testbed
+
+import shell
+
+
+class SnapshotTest(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def snapshot(self, statements):
+    session = shell.Session()
+    for statement in statements:
+      session.add_unpicklable(statement + '\n\n', [])
+    codes = [compile(statement, '<string>', 'exec')
+             for statement in session.unpicklables]
+    session.snapshot_unpicklables(codes, {'__builtins__': __builtins__})
+    return [statement.strip() for statement in session.unpicklables]
+
+  def test_redefinitions_are_collapsed(self):
+    self.assertEqual(['def f():\n  return 2'],
+                     self.snapshot(['def f():\n  return 1',
+                                    'def f():\n  return 2']))
+
+  def test_statements_with_side_effects_are_kept(self):
+    configure = ('import logging\n'
+                 'logging.getLogger("shell_test").setLevel(logging.DEBUG)')
+    self.assertEqual(['import logging', configure],
+                     self.snapshot(['import logging', configure,
+                                    'import logging']))
+
+  def test_definitions_that_run_code_are_kept(self):
+    decorated = '@staticmethod\ndef f(): pass'
+    class_body = 'class A(object):\n  n = len("abc")'
+    self.assertEqual([decorated, class_body, 'def f(): pass',
+                      'class A(object): pass'],
+                     self.snapshot([decorated, class_body, 'def f(): pass',
+                                    'class A(object): pass']))
+
+
+if __name__ == '__main__':
+  unittest.main()